@@ -1,8 +1,20 @@
-""" Usage: python gfl2conll.py infile.anno outfile.conll """
+""" Usage: python gfl2conll.py [-j N] [-e errors.txt] [-p SECONDS] infile.anno outfile.conll
+
+Records are read one at a time, so the input can be any size; '-' is
+stdin/stdout, and .gz files are read or written gzipped.  With -j N,
+records are converted in a pool of N processes, and the output is the
+same, in the same order.  Records that can't be converted are skipped,
+and reported (record number, error) on stderr or in the -e file. """
 
 import re
 import sys
+import gzip
+import time
+import itertools
 from gfl_parser import *
+from gfl_container import read_containers, open_anno
+
+CHUNKSIZE = 64  # records per task handed to a worker
 
 class NodeConll(object):
     def __init__(self, ind, tok, parent):
@@ -16,12 +28,26 @@ class NodeConll(object):
                     "_", "_", "_", str(self.parent), "_", "_", "_"])
 
 class ConverterGfl2Conll:
-    def __init__(self, gfl_parse, sentence):
-        self.sent = sentence.split()
-        self.gfl = goparse(self.sent, gfl_parse)
+    def __init__(self, gfl_parse, sentence=None):
+        """ gfl_parse is GFL code, or a finalized Parse or its to_json()
+        dict, which is used as it is instead of being parsed again.
+        sentence is the whitespace-separated tokens; for a Parse it
+        defaults to the parse's own tokens """
+        parsed = isinstance(gfl_parse, (Parse, dict))
+        if sentence is None and parsed:
+            tokens = gfl_parse.tokens if isinstance(gfl_parse, Parse) else gfl_parse['tokens']
+            sentence = " ".join(tokens)
+        self.sent = [unicodify(w) for w in sentence.split()]
+        self.gfl = gfl_parse if parsed else goparse(self.sent, gfl_parse)
         self.node_evals = {}
         self.conll = [NodeConll(1, "ROOT", 0)]
         self.node_equivs = {}
+        # position of the first occurrence of each token
+        self.positions = {}
+        for (i, w) in enumerate(self.sent):
+            self.positions.setdefault(w, i)
+        # node -> first node at or above it with an equiv (or the top of its chain)
+        self.equiv_above = {}
 
     def __get_original_token(self, tok):
         """ Returns the original form of a duplicate token
@@ -37,8 +63,18 @@ class ConverterGfl2Conll:
         """ Form a dictionary in which each variable node
         points through a series of edges to the node
         which its children should point to in CoNLL """
+        if isinstance(self.gfl, dict):
+            node_edges = self.gfl['node_edges']
+            node2words = self.gfl['node2words']
+            # JSON has the (word, label) pairs as lists
+            extra_node2words = dict((n, [tuple(w) for w in ws])
+                                    for (n, ws) in self.gfl['extra_node2words'].items())
+        else:
+            node_edges = self.gfl.node_edges
+            node2words = self.gfl.node2words
+            extra_node2words = self.gfl.extra_node2words
         cbb_edges = {}
-        for (head, child, label) in self.gfl.node_edges:
+        for (head, child, label) in node_edges:
             if label == "Anaph":
                 continue
             if label == "unspec":
@@ -53,14 +89,11 @@ class ConverterGfl2Conll:
             if child not in self.node_evals:
                 self.node_evals[child] = head
 
-        for (n, ws) in self.gfl.extra_node2words.items():
+        for (n, ws) in extra_node2words.items():
             # replace variable head with first coordinate
             # eg., "$x :: a :: {p q}" gives "$x":"p"
-            small = 500
-            for w in ws:
-                if w in self.sent:
-                    small = min([small, self.sent.index(w)])
-            if small == 500:
+            small = self.__first_position(ws)
+            if small is None:
                 continue
             head = self.sent[small]
 
@@ -69,12 +102,9 @@ class ConverterGfl2Conll:
             for w in ws:
                 if w[0] != self.node_equivs[n]:
                     self.node_evals[w[0]] = n
-        for (n, ws) in self.gfl.node2words.items():
-            small = 500
-            for w in ws:
-                if w in self.sent:
-                    small = min([small, self.sent.index(w)])
-            if small == 500:
+        for (n, ws) in node2words.items():
+            small = self.__first_position(ws)
+            if small is None:
                 continue
             head = self.sent[small]
 
@@ -89,61 +119,131 @@ class ConverterGfl2Conll:
             if n in self.node_evals:
                 self.node_evals[w] = self.node_evals[n]
 
+    def __first_position(self, ws):
+        """ Position in the sentence of the earliest of the words ws,
+        or None if none of them are in it """
+        found = [self.positions[w] for w in ws if w in self.positions]
+        return min(found) if found else None
+
+    def __find_equiv_above(self, node):
+        """ Follow node_evals up from node to the first node that has
+        an equiv, or to the top of the chain; paths are compressed, so
+        every node is climbed past only once """
+        path = []
+        curr = node
+        while (curr not in self.equiv_above and curr not in self.node_equivs
+               and curr in self.node_evals):
+            path.append(curr)
+            curr = self.node_evals[curr]
+        found = self.equiv_above.get(curr, curr)
+        for n in path:
+            self.equiv_above[n] = found
+        return found
+
     def __get_ancestor(self, tok):
         """ Return the most recent ancestor associated with a leaf token """
+        # climb node_evals from tok, past nodes whose equiv is tok itself
         curr = tok
-        while curr in self.node_evals:
+        while True:
             if (curr in self.node_equivs and self.node_equivs[curr] != tok):
-                break
-            curr = self.node_evals[curr]
-
-        if (curr in self.node_equivs and self.node_equivs[curr] != tok):
-            return self.sent.index(self.node_equivs[curr]) + 2
-        return 1
+                return self.positions[self.node_equivs[curr]] + 2
+            if curr not in self.node_evals:
+                return 1
+            curr = self.__find_equiv_above(self.node_evals[curr])
 
     def convert2conll(self):
         """ Convert a GFL statement to CONLL """
         if not len(self.node_evals):
             self.__evaluate_nodes()
-        ret = self.conll[0].tostring()
+        rows = [self.conll[0].tostring()]
 
         for (i, tok) in enumerate(self.sent):
             orig = self.__get_original_token(tok)
             parent = self.__get_ancestor(tok)
             self.conll.append(NodeConll(i+2, orig, parent))
-            ret = ret + "\n" + self.conll[i+1].tostring()
+            rows.append(self.conll[i+1].tostring())
 
-        return ret
+        return "\n".join(rows)
 
-if __name__ == "__main__":
-    infile = open(sys.argv[1], 'r')
-    outfile = open(sys.argv[2], 'w')
-
-    section = ""
-    text = ""
-    anno = ""
-    for line in infile:
-        if line.startswith("%"):
-            section = line.strip()
-            continue
-        if line.strip() == "---":
-            if not anno.strip() or not text.strip():
-                continue
-            t = ConverterGfl2Conll(anno, text)
-            outfile.write(t.convert2conll())
+def parse2conll(parse, sentence=None):
+    """ The CoNLL block for a finalized Parse, or its to_json() dict,
+    without parsing the GFL again """
+    return ConverterGfl2Conll(parse, sentence).convert2conll()
+
+def convert_record(record):
+    """ (CoNLL block, None) for a (number, tokens, code) record,
+    or (None, error message) if it can't be converted """
+    (n, tokens, code) = record
+    try:
+        return ConverterGfl2Conll(code, " ".join(tokens)).convert2conll(), None
+    except Exception, e:
+        return None, "{n}\t{name}: {msg}".format(n=n, name=type(e).__name__, msg=e)
+
+def open_output(filename):
+    """ '-' is stdout, and .gz files are gzipped """
+    if filename == "-":
+        return sys.stdout
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wb")
+    return open(filename, "w")
+
+def convert_stream(infile, outfile, errfile=None, jobs=1, progress=None):
+    """ Convert every record of the container file object infile, writing
+    CoNLL blocks to outfile in input order.  Records that fail are
+    reported on errfile (or skipped).  With jobs > 1, records are
+    converted in a pool of that many processes.  With progress, a line
+    of throughput goes to stderr every progress seconds.
+    Returns (records converted, records failed). """
+    records = ((n, tokens, code) for (n, (tokens, code, _))
+               in enumerate(read_containers(infile), 1) if tokens and code)
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(convert_record, records, CHUNKSIZE)
+    else:
+        results = itertools.imap(convert_record, records)
+
+    nconverted = nfailed = 0
+    start = last = time.time()
+    for (block, error) in results:
+        if error is not None:
+            nfailed += 1
+            if errfile is not None:
+                errfile.write(error.encode("utf8") if isinstance(error, unicode) else error)
+                errfile.write("\n")
+        else:
+            nconverted += 1
+            outfile.write(block.encode("utf8"))
             outfile.write("\n\n")
-            anno = ""
-            text = ""
-        elif section == "% ANNO":
-            anno += line
-        elif section == "% TEXT":
-            text += line
-
-    if anno.strip() and text.strip():
-        t = ConverterGfl2Conll(anno, text)
-        outfile.write(t.convert2conll())
-    infile.close()
-    outfile.close()
+        if progress and time.time() - last >= progress:
+            last = time.time()
+            print >>sys.stderr, "%d converted, %d failed, %.0f records/sec" % (
+                nconverted, nfailed, (nconverted + nfailed) / (last - start))
+    if jobs > 1:
+        pool.close()
+    return nconverted, nfailed
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    p = OptionParser(usage=__doc__.split("\n")[0].replace("Usage: ", "", 1).strip())
+    p.add_option("-j", "--jobs", dest="jobs", type="int", default=1, help="convert in N worker processes")
+    p.add_option("-e", "--errors", dest="errors", help="write records that fail to this file (default: stderr)")
+    p.add_option("-p", "--progress", dest="progress", type="float", help="report throughput every N seconds")
+    opts, args = p.parse_args()
+    if len(args) != 2:
+        p.error("need an input and an output file")
+
+    infile = open_anno(args[0])
+    outfile = open_output(args[1])
+    errfile = open(opts.errors, "w") if opts.errors else sys.stderr
+    start = time.time()
+    nconverted, nfailed = convert_stream(infile, outfile, errfile, opts.jobs, opts.progress)
+    elapsed = time.time() - start
+    print >>sys.stderr, "%d converted, %d failed, %.0f records/sec" % (
+        nconverted, nfailed, (nconverted + nfailed) / elapsed if elapsed else 0)
+    for f in (infile, outfile, errfile):
+        if f not in (sys.stdin, sys.stdout, sys.stderr):
+            f.close()
 
 def test_simple():
     # 1 a a 0
@@ -187,3 +287,38 @@ def test_dupes():
     # 5 a a 2
     t = ConverterGfl2Conll("a_1 < b < (c > a_2)", "a_1 b c a_2")
     return t.convert2conll()
+
+def test_long_sentence():
+    # heads past the 500th token, and no quadratic scans
+    words = ["w%d" % i for i in range(1200)]
+    code = "\n".join("%s > %s" % pair for pair in zip(words, words[1:]))
+    t = ConverterGfl2Conll(code, " ".join(words))
+    rows = [row.split("\t") for row in t.convert2conll().split("\n")]
+    assert len(rows) == 1201
+    assert [int(row[6]) for row in rows[1:]] == [i + 3 for i in range(1199)] + [1]
+
+def test_stream():
+    from StringIO import StringIO
+    anno = "---\n% TEXT\nI like it\n% ANNO\nI > like < it\n---\n% TEXT\nno way\n% ANNO\nno > > way\n---\n% TEXT\nthe cat\n% ANNO\nthe > cat\n"
+    for jobs in [1, 2]:
+        out, err = StringIO(), StringIO()
+        assert convert_stream(StringIO(anno), out, err, jobs=jobs) == (2, 1)
+        blocks = out.getvalue().split("\n\n")
+        assert blocks[-1] == "" and len(blocks) == 3
+        assert blocks[0].split("\n")[1].split("\t")[1:7:5] == ["I", "3"]
+        assert blocks[1].split("\n")[1].split("\t")[1] == "the"
+        assert err.getvalue().startswith("2\t")
+
+def test_from_parse():
+    import json
+    code = "(A Top Quality Sandwich*) > made > to > order"
+    sentence = "A Top Quality Sandwich made to order"
+    expected = ConverterGfl2Conll(code, sentence).convert2conll()
+    p = parse(sentence.split(), code)
+    assert parse2conll(p) == expected
+    assert parse2conll(json.loads(json.dumps(p.to_json())), sentence) == expected
+    # non-ASCII tokens find their heads too
+    sentence = "la d\xc3\xa9cision"
+    rows = parse2conll(parse(sentence.split(), "la > d\xc3\xa9cision")).split("\n")
+    assert [r.split("\t")[6] for r in rows] == ["0", "3", "1"]
+    assert rows == ConverterGfl2Conll("la > d\xc3\xa9cision", sentence).convert2conll().split("\n")
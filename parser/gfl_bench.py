@@ -0,0 +1,265 @@
+"""
+Benchmarks for the parse -> finalize -> JSON pipeline.
+
+Each sentence goes through the same steps as gfl_parser.parse() plus
+make_json.py's output step, and each step is timed on its own:
+
+  lex          gfl_lexer.tokenize()  (FastLexer when it needs the generated lexer)
+  ast          the native parser on those tokens (antlr_parse() when it falls back)
+  consistency  consistency_check()
+  build        build_parse(), i.e. process_chain() over every line
+  finalize     Parse.finalize()
+  semantics    graph_semantics_check()
+  to_json      Parse.to_json()
+  dumps        json.dumps() of that
+
+Workloads are the annotated corpus (anno/ and cbbs/) and synthetic
+sentences of a given length, made with a fixed random seed.  Each workload
+runs in a fresh process, so peak memory (max RSS) is its own.
+
+Output is one JSON object per workload on stdout: throughput, and per-stage
+total and percentile latencies in milliseconds.
+
+  python gfl_bench.py                         corpus, plus 10:1000 100:100 1000:10 10000:1
+  python gfl_bench.py corpus 10:1000000       a million 10-token sentences
+  python gfl_bench.py -r 5 100:1000 > now.jsonl
+
+Run tests with:
+  py.test -v gfl_bench.py
+"""
+
+import sys,random,platform,resource,multiprocessing,Queue
+try:
+  import ujson as json
+except ImportError:
+  import json
+from array import array
+from timeit import default_timer as clock
+import gfl_parser, gfl_lexer, gfl_rdparser
+from gfl_parser import ParseError, leaves, unicodify
+
+STAGES = ['lex', 'ast', 'consistency', 'build', 'finalize', 'semantics', 'to_json', 'dumps']
+PERCENTILES = [50, 90, 99]
+DEFAULT_WORKLOADS = ['corpus', '10:1000', '100:100', '1000:10', '10000:1']
+SEED = 12345
+POLL_SECONDS = 1.0  ## how often bench_isolated() checks its process is still alive
+
+#############################################
+## Workloads: iterables of (tokens, code)
+
+def corpus():
+  from gfl_container import read_containers
+  for filename in gfl_rdparser.corpus_files():
+    for tokens,code,_ in read_containers(open(filename)):
+      if code:
+        yield tokens, code
+
+def synthetic_sentence(n, rng):
+  """
+  An n-token sentence and a well-formed GFL annotation for it: a random
+  dependency tree over single words, [multi words] and (CBB brackets*).
+  """
+  tokens = [u'w%d' % i for i in range(n)]
+  units = []  ## (expression, what a head can be referred to by)
+  i = 0
+  while i < n:
+    r = rng.random()
+    if r < 0.1 and i+2 <= n:
+      mw = u'[%s %s]' % (tokens[i], tokens[i+1])
+      units.append((mw, mw))
+      i += 2
+    elif r < 0.2 and i+3 <= n:
+      units.append((u'(%s %s* %s)' % tuple(tokens[i:i+3]), tokens[i+1]))
+      i += 3
+    else:
+      units.append((tokens[i], tokens[i]))
+      i += 1
+  lines = [units[0][0]]
+  for k in range(1, len(units)):
+    head = units[rng.randrange(k)][1]
+    lines.append(u'%s < %s' % (head, units[k][0]))
+  return tokens, u'\n'.join(lines)
+
+def synthetic(ntokens, nsentences, seed=SEED):
+  rng = random.Random(seed)
+  for _ in xrange(nsentences):
+    yield synthetic_sentence(ntokens, rng)
+
+def workload(name):
+  """The sentences for a workload name: 'corpus', or 'TOKENS:SENTENCES'"""
+  if name == 'corpus':
+    return corpus()
+  try:
+    ntokens, nsentences = [int(float(x)) for x in name.split(':')]
+  except ValueError:
+    raise ValueError("bad workload %s: use 'corpus' or TOKENS:SENTENCES" % repr(name))
+  return synthetic(ntokens, nsentences)
+
+#############################################
+## Timing
+
+def run_stages(tokens, code, times):
+  """
+  What gfl_parser.parse(tokens, code, check_semantics=True) does, plus
+  json.dumps(to_json()), with each stage's seconds appended to times[stage].
+  Returns the JSON.
+  """
+  t0 = clock()
+  code = unicodify(code)
+  try:
+    toks = gfl_lexer.tokenize(code)
+  except gfl_lexer.Fallback:
+    toks = None
+    gfl_lexer.lex(code)
+  t1 = clock()
+  tree = None
+  if toks is not None:
+    try:
+      tree = gfl_rdparser.RDParser(toks).annotate()
+    except gfl_lexer.Fallback:
+      pass
+  if tree is None:
+    tree = gfl_parser.antlr_parse(code, parser='antlr').tree
+  t2 = clock()
+  text_tokens = [unicodify(x) for x in tokens]
+  if not list(leaves(tree)):
+    raise ParseError("no leaves in AST")
+  gfl_parser.consistency_check(text_tokens, tree)
+  t3 = clock()
+  p = gfl_parser.build_parse(text_tokens, tree)
+  t4 = clock()
+  p.finalize()
+  t5 = clock()
+  gfl_parser.graph_semantics_check(p)
+  t6 = clock()
+  d = p.to_json()
+  t7 = clock()
+  s = json.dumps(d)
+  t8 = clock()
+  for stage,a,b in zip(STAGES, [t0,t1,t2,t3,t4,t5,t6,t7], [t1,t2,t3,t4,t5,t6,t7,t8]):
+    times[stage].append(b-a)
+  return s
+
+def percentile(sorted_values, q):
+  if not sorted_values: return None
+  return sorted_values[int(round(q/100.0 * (len(sorted_values)-1)))]
+
+def summarize(samples):
+  """Total, mean and percentiles of a list of seconds, in milliseconds"""
+  values = sorted(samples)
+  d = {'total_ms': sum(values) * 1e3}
+  d['mean_ms'] = d['total_ms'] / len(values) if values else None
+  for q in PERCENTILES:
+    d['p%d_ms' % q] = percentile(values, q) * 1e3 if values else None
+  d['max_ms'] = values[-1] * 1e3 if values else None
+  return d
+
+def bench(name, repeat=1):
+  """Run one workload in this process; returns its result dict"""
+  times = {stage: array('d') for stage in STAGES}
+  sentences = tokens = errors = 0
+  start = clock()
+  for _ in range(repeat):
+    for toks,code in workload(name):
+      try:
+        run_stages(toks, code, times)
+      except Exception:
+        errors += 1
+        continue
+      sentences += 1
+      tokens += len(toks)
+  pipeline = sum(sum(times[stage]) for stage in STAGES)
+  return {
+    'workload': name,
+    'repeat': repeat,
+    'sentences': sentences,
+    'tokens': tokens,
+    'errors': errors,
+    'wall_seconds': clock() - start,
+    'pipeline_seconds': pipeline,
+    'sentences_per_sec': sentences / pipeline if pipeline else None,
+    'tokens_per_sec': tokens / pipeline if pipeline else None,
+    'stages': {stage: summarize(times[stage]) for stage in STAGES},
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'python': platform.python_version(),
+    'lexer': gfl_parser.LEXER,
+    'parser': gfl_parser.PARSER,
+  }
+
+def _bench_child(name, repeat, queue):
+  try:
+    queue.put(bench(name, repeat))
+  except Exception, e:
+    queue.put({'workload': name, 'error': "%s: %s" % (type(e).__name__, e)})
+
+def bench_isolated(name, repeat=1, timeout=None):
+  """
+  Run one workload in a fresh process, so its peak memory is its own.
+  If the process dies without a result (or takes more than timeout seconds),
+  the result is just the workload and the error, as when bench() raises.
+  """
+  queue = multiprocessing.Queue()
+  proc = multiprocessing.Process(target=_bench_child, args=(name, repeat, queue))
+  proc.start()
+  start = clock()
+  result = None
+  while result is None:
+    try:
+      result = queue.get(timeout=POLL_SECONDS)
+    except Queue.Empty:
+      if not proc.is_alive():
+        try:
+          result = queue.get(timeout=POLL_SECONDS)  ## it may have put the result just before exiting
+        except Queue.Empty:
+          result = {'workload': name, 'error': "benchmark process died with exit code %s" % proc.exitcode}
+      elif timeout is not None and clock() - start > timeout:
+        proc.terminate()
+        result = {'workload': name, 'error': "benchmark process timed out after %g seconds" % timeout}
+  proc.join()
+  return result
+
+#############################################
+
+def test_synthetic():
+  for n in [1, 2, 3, 10, 57]:
+    for tokens,code in synthetic(n, 5):
+      p = gfl_parser.parse(tokens, code, check_semantics=True)
+      assert len(p.tokens) == n
+
+def test_stages_match_parse():
+  times = {stage: [] for stage in STAGES}
+  for tokens,code in list(corpus())[:20] + list(synthetic(30, 5)) + [("a b".split(), u"a \\v")]:
+    try:
+      expected = json.dumps(gfl_parser.parse(tokens, code, check_semantics=True).to_json())
+    except Exception, e:
+      import pytest
+      with pytest.raises(type(e)):
+        run_stages(tokens, code, times)
+      continue
+    assert run_stages(tokens, code, times) == expected
+  assert len(set(len(v) for v in times.values())) == 1
+
+def test_isolated_crash(monkeypatch):
+  import os
+  monkeypatch.setattr(sys.modules[__name__], '_bench_child', lambda name, repeat, queue: os._exit(3))
+  result = bench_isolated('10:1')
+  assert result == {'workload': '10:1', 'error': "benchmark process died with exit code 3"}
+
+def test_bench():
+  result = bench('10:20')
+  assert result['sentences'] == 20 and result['errors'] == 0
+  assert set(result['stages']) == set(STAGES)
+  assert result['stages']['build']['p50_ms'] <= result['stages']['build']['max_ms']
+  json.dumps(result)
+
+if __name__=='__main__':
+  from optparse import OptionParser
+  p = OptionParser(usage="%prog [-r N] [corpus | TOKENS:SENTENCES ...]")
+  p.add_option('-r', '--repeat', dest="repeat", type='int', default=1, help="run each workload N times")
+  p.add_option('--in-process', dest="in_process", action='store_true', help="don't fork a process per workload")
+  opts,args = p.parse_args()
+  for name in args or DEFAULT_WORKLOADS:
+    workload(name)  ## check the name before forking
+    result = bench(name, opts.repeat) if opts.in_process else bench_isolated(name, opts.repeat)
+    print json.dumps(result, sort_keys=True)
+    sys.stdout.flush()
@@ -0,0 +1,228 @@
+"""
+A persistent on-disk cache in front of gfl_parser.parse(), so re-checking a
+tree of annotations only parses the records that changed.
+
+Entries are keyed on a hash of the tokens, the code after clean_code(), the
+check_semantics flag, and the source of the parser modules, so editing the
+parser invalidates everything.  What's stored is the outcome of parsing:
+the to_json() result as JSON text, or the error it raised.
+
+Entries live in an SQLite file.  When the file grows past max_bytes, the
+least recently used entries are evicted.  A ParseCache can be shared between
+threads (multiprocessing.Pool.imap reads its input from a thread of its own),
+but not between processes.
+
+  cache = ParseCache('parses.cache')
+  p = cache.parse(tokens, code)    ## a Parse, or raises like gfl_parser.parse()
+  print cache.stats()
+  cache.close()
+
+Run tests with:
+  py.test -v gfl_cache.py
+"""
+
+import os,sqlite3,hashlib,exceptions,threading
+try:
+  import ujson as json
+except ImportError:
+  import json
+import gfl_parser
+from gfl_parser import Parse, ParseError, clean_code, unicodify
+
+MAX_BYTES = 256 * 2**20
+COMMIT_EVERY = 1000  ## writes
+
+## Modules whose source goes into every key
+PARSER_MODULES = ['gfl_parser', 'gfl_rdparser', 'gfl_lexer', 'psfParser', 'psfLexer']
+_parser_version = None
+
+def parser_version():
+  """A hash of the parser's source code"""
+  global _parser_version
+  if _parser_version is None:
+    h = hashlib.sha1()
+    for name in PARSER_MODULES:
+      filename = __import__(name).__file__
+      if filename.endswith('.pyc') or filename.endswith('.pyo'):
+        filename = filename[:-1]
+      h.update(open(filename, 'rb').read())
+    _parser_version = h.hexdigest()
+  return _parser_version
+
+def cache_key(tokens, code, check_semantics=False):
+  tokens = [unicodify(t) for t in tokens]
+  s = json.dumps([parser_version(), bool(check_semantics), tokens, clean_code(unicodify(code))])
+  return hashlib.sha1(s.encode('utf8') if isinstance(s, unicode) else s).hexdigest()
+
+def parse_outcome(tokens, code, check_semantics=False):
+  """
+  Parse for real.  Returns (parse JSON, None), or (None, "ExcName: message")
+  if parsing raised; the same format that's cached.
+  """
+  try:
+    p = gfl_parser.parse(tokens, code, check_semantics=check_semantics)
+  except Exception, e:
+    return None, "{name}: {msg}".format(name=type(e).__name__, msg=e)
+  return json.dumps(p.to_json()), None
+
+def raise_error(error):
+  """Re-raise a cached "ExcName: message" as that exception (or a ParseError)"""
+  name,_,msg = error.partition(': ')
+  cls = getattr(gfl_parser, name, None) or getattr(exceptions, name, None)
+  if not (isinstance(cls, type) and issubclass(cls, Exception)):
+    cls = ParseError
+  raise cls(msg)
+
+class ParseCache(object):
+  def __init__(self, filename, max_bytes=MAX_BYTES):
+    self.filename = filename
+    self.max_bytes = max_bytes
+    self.lock = threading.RLock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.text_factory = str
+    self.db.execute("""CREATE TABLE IF NOT EXISTS parses
+        (key TEXT PRIMARY KEY, parse TEXT, error TEXT, size INTEGER, used INTEGER)""")
+    self.db.execute("CREATE INDEX IF NOT EXISTS parses_used ON parses (used)")
+    ## 'used' is a counter, not a time: bigger means more recently used
+    used,total = self.db.execute("SELECT MAX(used), SUM(size) FROM parses").fetchone()
+    self.clock = used or 0
+    self.total_bytes = total or 0
+    self.writes = 0
+    self.hits = self.misses = self.evictions = 0
+
+  key = staticmethod(cache_key)
+
+  def get(self, key):
+    """(parse JSON, error) for this key, or None if it's not cached"""
+    with self.lock:
+      row = self.db.execute("SELECT parse, error FROM parses WHERE key=?", (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.clock += 1
+      self.db.execute("UPDATE parses SET used=? WHERE key=?", (self.clock, key))
+      self.wrote()
+      return row
+
+  def put(self, key, outcome):
+    """Store (parse JSON, error) for this key"""
+    parse_json, error = outcome
+    size = len(key) + len(parse_json or '') + len(error or '')
+    with self.lock:
+      self.clock += 1
+      old = self.db.execute("SELECT size FROM parses WHERE key=?", (key,)).fetchone()
+      if old is not None:
+        self.total_bytes -= old[0]
+      self.db.execute("INSERT OR REPLACE INTO parses VALUES (?,?,?,?,?)",
+          (key, parse_json, error, size, self.clock))
+      self.total_bytes += size
+      if self.total_bytes > self.max_bytes:
+        self.evict()
+      self.wrote()
+
+  def evict(self):
+    """Drop least recently used entries until we're down to 90% of max_bytes"""
+    target = self.max_bytes * 0.9
+    while self.total_bytes > target:
+      rows = self.db.execute("SELECT key, size FROM parses ORDER BY used LIMIT 100").fetchall()
+      if not rows: break
+      for key,size in rows:
+        if self.total_bytes <= target: break
+        self.db.execute("DELETE FROM parses WHERE key=?", (key,))
+        self.total_bytes -= size
+        self.evictions += 1
+
+  def wrote(self):
+    self.writes += 1
+    if self.writes % COMMIT_EVERY == 0:
+      self.db.commit()
+
+  def outcome(self, tokens, code, check_semantics=False):
+    """(parse JSON, error) from the cache, parsing only on a miss"""
+    key = self.key(tokens, code, check_semantics)
+    outcome = self.get(key)
+    if outcome is None:
+      outcome = parse_outcome(tokens, code, check_semantics)
+      self.put(key, outcome)
+    return outcome
+
+  def parse(self, tokens, code, check_semantics=False):
+    """Same as gfl_parser.parse(), through the cache"""
+    parse_json, error = self.outcome(tokens, code, check_semantics)
+    if error is not None:
+      raise_error(error)
+    return Parse.from_json(json.loads(parse_json))
+
+  def stats(self):
+    return "parse cache: %d hits, %d misses, %d evicted, %d KB in %s" % (
+        self.hits, self.misses, self.evictions, self.total_bytes // 1024, self.filename)
+
+  def close(self):
+    with self.lock:
+      self.db.commit()
+      self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+#############################################
+
+def temp_cache(**kwargs):
+  import tempfile
+  fd,filename = tempfile.mkstemp(suffix='.cache')
+  os.close(fd)
+  return ParseCache(filename, **kwargs)
+
+def test_hits():
+  import string
+  cache = temp_cache()
+  try:
+    p = cache.parse(string.letters, "a > b")
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert cache.parse(string.letters, " a > b\n   ").to_json() == p.to_json()
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.parse(string.letters, "a > b", check_semantics=True)
+    cache.parse(list(string.letters) + ['x'], "a > b")
+    assert (cache.hits, cache.misses) == (1, 3)
+    cache.close()
+    # and it's still there after reopening
+    cache = ParseCache(cache.filename)
+    cache.parse(string.letters, "a > b")
+    assert (cache.hits, cache.misses) == (1, 0)
+  finally:
+    cache.close()
+    os.remove(cache.filename)
+
+def test_errors():
+  import pytest,string
+  cache = temp_cache()
+  try:
+    for i in range(2):
+      with pytest.raises(gfl_parser.InvalidGraph):
+        cache.parse(string.letters, "z > a \n z > b", check_semantics=True)
+      with pytest.raises(ParseError):
+        cache.parse("a b".split(), "a > c")
+    assert (cache.hits, cache.misses) == (2, 2)
+  finally:
+    cache.close()
+    os.remove(cache.filename)
+
+def test_eviction():
+  import string
+  cache = temp_cache(max_bytes=2000)
+  try:
+    codes = ["%s > %s" % pair for pair in zip(string.letters[:20], string.letters[1:21])]
+    for code in codes:
+      cache.parse(string.letters, code)
+    assert cache.evictions > 0 and cache.total_bytes <= 2000
+    cache.parse(string.letters, codes[-1])
+    assert cache.hits == 1
+    cache.parse(string.letters, codes[0])
+    assert cache.hits == 1
+  finally:
+    cache.close()
+    os.remove(cache.filename)
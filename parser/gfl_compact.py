@@ -0,0 +1,196 @@
+"""
+A compact, read-only form of a finalized Parse, for holding whole corpora
+in memory.
+
+Nodes are numbered in sorted order, like Parse.node2id, and everything else
+is stored as ints in flat arrays:
+
+  edge_heads, edge_children   node ids, one entry per node edge
+  edge_labels                 index into LABELS
+  word_offsets, word_ids      node2words, CSR style: the words of node i are
+                              tokens[j] for j in word_ids[word_offsets[i]:word_offsets[i+1]]
+  extra_offsets, extra_ids, extra_labels
+                              extra_node2words, the same way, with a label per word
+
+Node names are not stored when they can be rebuilt from the node's words,
+i.e. W(word) and MW(a_b) with the words in token order; CBBs, $-variables
+and the like keep a string.
+
+CompactParse.from_json(d).to_json() == d for any Parse.to_json() dict d, up
+to the order of each node's word list (those are sets in a Parse; here they
+come out in token order).
+
+Run tests with:
+  py.test -v gfl_compact.py
+"""
+
+from array import array
+
+## Edge and word labels.  Anything else found in a parse gets added on the end.
+LABELS = [None, 'unspec', 'cbbhead', 'Conj', 'Anaph', 'Coord']
+_label_ids = {label:i for i,label in enumerate(LABELS)}
+
+def label_id(label):
+  if label not in _label_ids:
+    _label_ids[label] = len(LABELS)
+    LABELS.append(label)
+  return _label_ids[label]
+
+def csr(lists):
+  """(offsets, flat) int arrays for a list of int lists"""
+  offsets = array('i', [0])
+  flat = array('i')
+  for x in lists:
+    flat.extend(x)
+    offsets.append(len(flat))
+  return offsets, flat
+
+def derived_name(words):
+  """The name process_chain() would give a node with these words, in phrase order"""
+  if len(words) == 1:
+    return u'W(' + words[0] + u')'
+  return u'MW(' + u'_'.join(words) + u')'
+
+class CompactParse(object):
+  """
+  A frozen, array-backed Parse.  Build one with from_json() or from_parse(),
+  get the dict back with to_json().
+  """
+  __slots__ = ['tokens', 'num_nodes', 'names', 'edge_heads', 'edge_children', 'edge_labels',
+      'word_offsets', 'word_ids', 'extra_offsets', 'extra_ids', 'extra_labels', 'empty_keys']
+
+  @classmethod
+  def from_parse(cls, parse):
+    return cls.from_json(parse.to_json())
+
+  @classmethod
+  def from_json(cls, d):
+    self = cls()
+    self.tokens = tuple(d['tokens'])
+    position = {}
+    for i,w in enumerate(self.tokens):
+      position.setdefault(w, i)
+    def word_id(w):
+      if w not in position:
+        raise ValueError("word %s is not one of the tokens" % repr(w))
+      return position[w]
+
+    # nodes that only appear in extra_node2words go after the real ones
+    names = list(d['nodes'])
+    self.num_nodes = len(names)
+    listed = set(names)
+    for n in sorted(set(d['node2words']) | set(d['extra_node2words'])):
+      if n not in listed:
+        names.append(n)
+    node_id = {n:i for i,n in enumerate(names)}
+
+    heads, children, labels = array('i'), array('i'), array('b')
+    for h,c,label in d['node_edges']:
+      heads.append(node_id[h])
+      children.append(node_id[c])
+      labels.append(label_id(label))
+    self.edge_heads, self.edge_children, self.edge_labels = heads, children, labels
+
+    node2words = d['node2words']
+    word_lists = [sorted(word_id(w) for w in node2words.get(n, ())) for n in names]
+    self.word_offsets, self.word_ids = csr(word_lists)
+
+    extra = d['extra_node2words']
+    extra_lists = [sorted((word_id(w), label_id(label)) for w,label in extra.get(n, ())) for n in names]
+    self.extra_offsets, self.extra_ids = csr([w for w,_ in pairs] for pairs in extra_lists)
+    self.extra_labels = array('b', (label for pairs in extra_lists for _,label in pairs))
+
+    # a key with no words is different from no key at all
+    self.empty_keys = tuple(sorted(node_id[n] for n,ws in node2words.items() if not ws)) \
+        + tuple(-1-node_id[n] for n,ws in extra.items() if not ws)
+
+    # keep a name only where it can't be rebuilt from the words
+    kept = []
+    for i,n in enumerate(names):
+      words = [self.tokens[j] for j in word_lists[i]]
+      kept.append(None if words and n == derived_name(words) else n)
+    self.names = tuple(kept)
+    return self
+
+  def __len__(self):
+    return self.num_nodes
+
+  def node_words(self, i):
+    """The words of node i, in token order"""
+    return [self.tokens[j] for j in self.word_ids[self.word_offsets[i]:self.word_offsets[i+1]]]
+
+  def node_name(self, i):
+    name = self.names[i]
+    if name is None:
+      return derived_name(self.node_words(i))
+    return name
+
+  def edges(self):
+    """(head name, child name, label) for every node edge, in sorted order"""
+    name = self.node_name
+    for h,c,label in zip(self.edge_heads, self.edge_children, self.edge_labels):
+      yield name(h), name(c), LABELS[label]
+
+  def to_json(self):
+    names = [self.node_name(i) for i in range(len(self.names))]
+    d = {}
+    d['node2words'] = {}
+    d['extra_node2words'] = {}
+    for i,n in enumerate(names):
+      a,b = self.word_offsets[i], self.word_offsets[i+1]
+      if a < b or i in self.empty_keys:
+        d['node2words'][n] = [self.tokens[j] for j in self.word_ids[a:b]]
+      a,b = self.extra_offsets[i], self.extra_offsets[i+1]
+      if a < b or -1-i in self.empty_keys:
+        d['extra_node2words'][n] = [(self.tokens[self.extra_ids[k]], LABELS[self.extra_labels[k]]) for k in range(a,b)]
+    d['node_edges'] = [(names[h], names[c], LABELS[label])
+        for h,c,label in zip(self.edge_heads, self.edge_children, self.edge_labels)]
+    d['tokens'] = list(self.tokens)
+    d['nodes'] = names[:self.num_nodes]
+    return d
+
+#############################################
+
+def normalized(d):
+  """A to_json() dict with the word lists sorted, for comparing"""
+  d = dict(d)
+  d['node2words'] = {n:sorted(ws) for n,ws in d['node2words'].items()}
+  d['extra_node2words'] = {n:sorted(tuple(x) for x in ws) for n,ws in d['extra_node2words'].items()}
+  d['node_edges'] = [tuple(e) for e in d['node_edges']]
+  return d
+
+def assert_roundtrip(d):
+  c = CompactParse.from_json(d)
+  assert normalized(c.to_json()) == normalized(d)
+  assert CompactParse.from_json(c.to_json()).to_json() == c.to_json()
+  return c
+
+def test_roundtrip():
+  import string,json
+  from gfl_parser import parse
+  for code in ["a < b < c", "[b a] > c", "[a b] > (c d* e) \n $x :: {a c} :: {d e}", "a > b \n a = b",
+      "$x :: b :: (c d)", "a"]:
+    p = parse(string.letters, code)
+    c = assert_roundtrip(p.to_json())
+    assert list(c.edges()) == sorted(p.node_edges)
+    assert_roundtrip(json.loads(json.dumps(p.to_json())))
+
+def test_arrays():
+  from gfl_parser import parse
+  c = parse("the good dog barked".split(), "the > [good dog] > barked").compact()
+  assert c.names == (None, None, None)
+  assert [c.node_name(i) for i in range(len(c))] == [u'MW(good_dog)', u'W(barked)', u'W(the)']
+  assert list(c.edge_heads) == [0, 1] and list(c.edge_children) == [2, 0]
+  assert list(c.word_offsets) == [0, 2, 3, 4] and list(c.word_ids) == [1, 2, 3, 0]
+
+def test_corpus():
+  from gfl_parser import parse_many
+  from gfl_rdparser import corpus_files
+  from gfl_container import read_containers
+  records = [(tokens,code) for f in corpus_files() for tokens,code,_ in read_containers(open(f)) if code]
+  n = 0
+  for p in parse_many(records):
+    if not isinstance(p, Exception):
+      assert_roundtrip(p.to_json())
+      n += 1
+  assert n > 50
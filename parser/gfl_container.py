@@ -0,0 +1,121 @@
+"""
+Reading the .anno container format, one annotation record at a time.
+
+A container file holds records separated by '---' lines.  Each record has
+sections that start with a '%' line: '% TEXT' is the tokenized sentence and
+'% ANNO' is its GFL code.  A file with no '%' in it at all is just one bare
+piece of GFL code.
+
+read_containers() works on any file object (stdin, gzip...) and only keeps
+one record in memory, so it's fine for huge concatenated dumps.
+
+Run tests with:
+  py.test -v gfl_container.py
+"""
+
+import re,sys,gzip,string,itertools
+
+SEPARATOR = re.compile(r'--- *\Z')
+
+def parse_parts(tweet_text):
+  s = tweet_text
+  s = re.sub('^--- *', '', s)
+  lines = s.split('\n')
+  lines = [L.strip() for L in lines if L.strip()]
+
+  parts = re.split(r'(\n|^)%', s)
+  parts = [x.strip() for x in parts]
+  parts = [x for x in parts if x]
+  pairs = []
+  for part in parts:
+    lines = part.split('\n')
+    if len(lines)==1:
+      L = lines[0]
+      if len(L.split())==2:
+        pairs.append(L.split())
+        continue
+    key = lines[0].strip()
+    value = '\n'.join(lines[1:]).strip()
+    pairs.append((key,value))
+  return dict(pairs)
+
+def record_tuple(anno_text):
+  """(tokens, code, anno_text) for the text of one record"""
+  container = parse_parts(anno_text)
+  tokens = container.get('TEXT','').split()
+  code = container.get('ANNO','').strip()
+  return tokens, code, anno_text
+
+def read_containers(f):
+  """
+  Yields (tokens, code, anno_text) for each non-empty record in the file
+  object f.  anno_text is the record's own text, starting with '---'.
+  A file with no '%' in it gives one record: all the letters as tokens,
+  and the whole file as the code.
+  """
+  lines = iter(f)
+  head = []  ## everything up to the first '%'
+  for line in lines:
+    head.append(line)
+    if '%' in line: break
+  else:
+    text = ''.join(head).strip()
+    yield string.letters, text, text
+    return
+
+  record = []
+  started = False
+  for line in itertools.chain(head, lines):
+    line = line.rstrip('\n')
+    if line.endswith('\r'): line = line[:-1]
+    # leading whitespace of the whole file doesn't count
+    if SEPARATOR.match(line if started else line.lstrip()):
+      text = '\n'.join(record).strip()
+      if text:
+        yield record_tuple('---\n' + text)
+      record = []
+    else:
+      record.append(line)
+    started = started or bool(line.strip())
+  text = '\n'.join(record).strip()
+  if text:
+    yield record_tuple('---\n' + text)
+
+def open_anno(filename):
+  """A file object for reading a container file: '-' is stdin, and .gz files are gunzipped."""
+  if filename == '-':
+    return sys.stdin
+  if filename.endswith('.gz'):
+    return gzip.open(filename)
+  return open(filename)
+
+#############################################
+
+def records(text):
+  from StringIO import StringIO
+  return list(read_containers(StringIO(text)))
+
+def test_bare_code():
+  assert records("a > b\n") == [(string.letters, "a > b", "a > b")]
+  assert records("") == [(string.letters, "", "")]
+
+def test_records():
+  text = "---\n% ID 123\n% TEXT\nthe dog\n% ANNO\nthe > dog\n---\n\n--- \n% TEXT\na b\n\n%ANNO\n a < b \r\n"
+  assert records(text) == [
+      ("the dog".split(), "the > dog", "---\n% ID 123\n% TEXT\nthe dog\n% ANNO\nthe > dog"),
+      ("a b".split(), "a < b", "---\n% TEXT\na b\n\n%ANNO\n a < b"),
+      ]
+
+def test_leading_whitespace():
+  assert records("\n  --- \n% TEXT\na\n% ANNO\na\n---") == [(["a"], "a", "---\n% TEXT\na\n% ANNO\na")]
+
+def test_gzip():
+  import os,tempfile
+  text = "---\n% TEXT\nthe dog\n% ANNO\nthe > dog\n"
+  fd,filename = tempfile.mkstemp(suffix='.anno.gz')
+  os.close(fd)
+  try:
+    g = gzip.open(filename, 'w'); g.write(text); g.close()
+    assert list(read_containers(open_anno(filename))) == records(text)
+  finally:
+    os.remove(filename)
@@ -0,0 +1,202 @@
+"""
+A fast drop-in replacement for the generated psfLexer.
+("psfLexer.py" is the ANTLR lexer.)
+
+The token set in psf.g is small enough that one precompiled regex covers it.
+The alternatives are ordered so that the first one to match gives the same
+answer as the ANTLR lexer: the longest match, with ties going to the rule
+listed earlier in psf.g.
+
+The one place where the generated lexer does something stranger than longest
+match is a backslash: after '\\' followed by whitespace it commits to
+VOCTAG/INTTAG and reports errors from there.  Tokens starting with a
+backslash, and any character no rule accepts, are handed to the generated
+lexer for exactly one token.  It sees the same char stream, so error
+reporting and recovery are identical.
+
+Run tests with:
+  py.test -v gfl_lexer.py
+"""
+
+import re
+import antlr3
+from antlr3 import CommonToken, TokenSource, EOF_TOKEN, DEFAULT_CHANNEL, HIDDEN_CHANNEL
+from psfLexer import psfLexer
+from psfLexer import COMMENT,DCOLON,DOLLARTOKEN,EATWS,EQ,HEAD,LARROW,LCB,LRB,LSB,NEWLINE,RARROW,RCB,RRB,RSB,TOKEN
+
+## Character classes, straight from the fragments in psf.g
+NL = u'\n\r\u2028\u2029'
+WS = u'\t\u000b\u000c \u00a0\u1680\u2000-\u200b\u202f\u3000'
+## the generated lexer never accepts \uffff or anything above the BMP
+NEVER = u'\uffff\U00010000-\U0010ffff' if len(u'\U00010000') == 1 else u'\uffff'
+## ~(NL|WS|HEAD|RCB|RRB|RSB|LCB|LRB|LSB|SRARROW|SLARROW)
+TOKEN_RE = u'[^%s%s%s*}\\])\\[{(><]' % (NL, WS, NEVER)
+
+LEXER_RE = re.compile(u'|'.join([
+  u'(?P<EATWS>[%s]+)' % WS,
+  u'(?P<NEWLINE>[%s]+)' % NL,
+  u'(?P<HEAD>\\*)',
+  u'(?P<LSB>\\[)',
+  u'(?P<RSB>\\])',
+  u'(?P<LCB>\\{)',
+  u'(?P<RCB>\\})',
+  u'(?P<LRB>\\()',
+  u'(?P<RRB>\\))',
+  u'(?P<RARROW>>|-+>)',
+  u'(?P<LARROW><-*)',
+  u'(?P<COMMENT>//[^%s%s]*)' % (NL, NEVER),
+  ## these tie with TOKEN and win only if TOKEN can't go any further
+  u'(?P<DCOLON>::)(?!%s)' % TOKEN_RE,
+  u'(?P<EQ>=)(?!%s)' % TOKEN_RE,
+  u'(?P<DOLLARTOKEN>\\$[a-zA-Z_][a-zA-Z0-9_]*)(?!%s)' % TOKEN_RE,
+  u'(?P<SLOW>\\\\)',
+  u'(?P<TOKEN>%s+)' % TOKEN_RE,
+  ]))
+
+TYPES = {
+  'EATWS':EATWS, 'NEWLINE':NEWLINE, 'HEAD':HEAD, 'LSB':LSB, 'RSB':RSB, 'LCB':LCB, 'RCB':RCB,
+  'LRB':LRB, 'RRB':RRB, 'RARROW':RARROW, 'LARROW':LARROW, 'COMMENT':COMMENT,
+  'DCOLON':DCOLON, 'EQ':EQ, 'DOLLARTOKEN':DOLLARTOKEN, 'TOKEN':TOKEN,
+}
+ON_CHANNEL = {name for name,t in TYPES.items() if t not in (EATWS, NEWLINE, COMMENT)}
+CHANNELS = {t: (HIDDEN_CHANNEL if t in (EATWS, NEWLINE, COMMENT) else DEFAULT_CHANNEL) for t in TYPES.values()}
+
+class Fallback(Exception):
+  """Raised when some input needs the generated ANTLR recognizers after all."""
+
+class FastToken(CommonToken):
+  """A CommonToken, minus the keyword-argument and oldToken handling in its constructor."""
+  def __init__(self, type, channel, text, input, start, stop, line, charPositionInLine):
+    self.type = type
+    self.channel = channel
+    self._text = text
+    self.input = input
+    self.start = start
+    self.stop = stop
+    self.line = line
+    self.charPositionInLine = charPositionInLine
+    self.index = -1
+
+class FastLexer(TokenSource):
+  """
+  Token source with the same interface as psfLexer: give it an
+  ANTLRStringStream and hand it to a CommonTokenStream.
+  Tokens have the same type, channel, text, line, column and start/stop.
+  """
+  def __init__(self, input=None):
+    TokenSource.__init__(self)
+    self.input = input
+    self._fallback = None
+
+  def reset(self):
+    if self.input is not None:
+      self.input.reset()
+
+  def setCharStream(self, input):
+    self.input = input
+    if self._fallback is not None:
+      self._fallback.setCharStream(input)
+
+  def fallback(self):
+    """The generated lexer, sharing our char stream; only built when needed."""
+    if self._fallback is None:
+      self._fallback = psfLexer(self.input)
+    return self._fallback
+
+  def nextToken(self):
+    input = self.input
+    data = input.data
+    start = input.p
+    if start >= input.n:
+      return EOF_TOKEN
+    m = LEXER_RE.match(data, start)
+    if m is None or m.lastgroup == 'SLOW':
+      return self.fallback().nextToken()
+
+    stop = m.end()
+    text = m.group()
+    ttype = TYPES[m.lastgroup]
+    t = FastToken(ttype, CHANNELS[ttype], text, input, start, stop-1, input.line, input.charPositionInLine)
+
+    # advance the stream as ANTLRStringStream.consume() would: only '\n' starts a line
+    input.p = stop
+    newlines = text.count(u'\n') if ttype == NEWLINE else 0
+    if newlines:
+      input.line += newlines
+      input.charPositionInLine = stop - (data.rindex(u'\n', start, stop) + 1)
+    else:
+      input.charPositionInLine += stop - start
+    return t
+
+def lex(code, lexer_class=FastLexer):
+  """All tokens for this code, hidden ones included. For testing and debugging."""
+  lexer = lexer_class(antlr3.ANTLRStringStream(code))
+  tokens = []
+  while True:
+    t = lexer.nextToken()
+    if t.type == antlr3.EOF:
+      return tokens
+    tokens.append(t)
+
+def tokenize(code):
+  """
+  Just the (type, text) pairs of the on-channel tokens, without building any
+  CommonTokens; this is what the native parser (gfl_rdparser.py) reads.
+  Raises Fallback wherever FastLexer would defer to the generated lexer.
+  """
+  tokens = []
+  pos = 0
+  for m in LEXER_RE.finditer(code):
+    kind = m.lastgroup
+    if m.start() != pos or kind == 'SLOW':
+      raise Fallback(pos)
+    pos = m.end()
+    if kind in ON_CHANNEL:
+      tokens.append((TYPES[kind], m.group()))
+  if pos != len(code):
+    raise Fallback(pos)
+  return tokens
+
+#############################################
+
+def token_info(t):
+  return (t.type, t.channel, t.text, t.line, t.charPositionInLine, t.start, t.stop)
+
+def assert_same_tokens(code):
+  fast = [token_info(t) for t in lex(code, FastLexer)]
+  slow = [token_info(t) for t in lex(code, psfLexer)]
+  assert fast == slow, (code, fast, slow)
+
+def test_token_types():
+  for code in [u"a < b < c", u"a > b > c", u"a --> b <-- c", u"a-->b", u"--", u"-->", u"<->",
+      u"a :: b", u"::", u"::a", u"a::b", u"= =", u"==", u"a=b", u"$x", u"$x-y", u"$1", u"$",
+      u"[a b] > {c d}", u"(a b* c)", u"a*", u"//comment\nb", u"a//b", u"/ /"]:
+    assert_same_tokens(code)
+
+def test_tags():
+  for code in [u"a \\v", u"\\vo", u"\\ voc", u"\\ vocative", u"\\INT", u"\\v*", u"\\vocat)", u"a\\ v"]:
+    assert_same_tokens(code)
+
+def test_whitespace_and_lines():
+  for code in [u"a\n \nb", u"x\r\ny", u"a\u2028b", u"a\u00a0b", u"a\u3000b  \t c\n\n\nd > e",
+      u"\n\n  $x :: {a b} :: c\n  a = b // hi\n"]:
+    assert_same_tokens(code)
+
+def test_fallback():
+  # these are lexer errors for the generated lexer; the fast one must recover the same way
+  for code in [u"\\ x", u"\\ vo y", u"a \uffff b"]:
+    assert_same_tokens(code)
+
+def test_tokenize():
+  for code in [u"a --> b <-- c", u"$x :: {a b} :: c // hi\n a = b", u"a\u3000b"]:
+    assert tokenize(code) == [(t.type, t.text) for t in lex(code) if t.channel == DEFAULT_CHANNEL]
+  import pytest
+  for code in [u"a \\v", u"\\o/", u"a \uffff"]:
+    with pytest.raises(Fallback):
+      tokenize(code)
+
+def test_anno_files():
+  import glob,os
+  d = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+  for filename in glob.glob(d+'/anno/*.anno') + glob.glob(d+'/anno/*/*.anno') + glob.glob(d+'/cbbs/*/*.anno'):
+    assert_same_tokens(open(filename).read().decode('utf8'))
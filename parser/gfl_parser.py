@@ -20,12 +20,21 @@ except ImportError:
 
 VERBOSE = False
 
+## Which lexer antlr_parse() uses: 'fast' (gfl_lexer.py) or 'antlr' (the generated psfLexer).
+## Both give the same token stream.
+LEXER = 'fast'
+## Which parser antlr_parse() uses: 'native' (gfl_rdparser.py) or 'antlr' (the generated psfParser).
+## The native one hands anything unusual back to ANTLR, so both give the same trees.
+PARSER = 'native'
+
 class ParseError(Exception): pass
 class InvalidGraph(ParseError): pass
 
 import antlr3
 from psfLexer import psfLexer
 from psfParser import psfParser
+from gfl_lexer import FastLexer
+import gfl_rdparser
 
 alltypes = "COMMENT DCOLON DOLLARTOKEN EQ EOF HEAD INTTAG LARROW LCB LRB LSB NEWLINE RARROW RCB RRB RSB TOKEN Tokens VOCTAG WS".split()
 from psfLexer import COMMENT,DCOLON,DOLLARTOKEN,EOF,EQ,HEAD,INTTAG,LARROW,LCB,LRB,LSB,NEWLINE,RARROW,RCB,RRB,RSB,TOKEN,Tokens,VOCTAG,WS
@@ -43,6 +52,11 @@ class Parse:
     self.extra_node2words = defaultdict(set)   ## (word,label) pairs
     self.node_edges = set()  ## (head, child, label) ... all strings
 
+    ## indexes over the above, kept up to date by the State manipulation methods
+    self.edges_by_head = defaultdict(set)   ## head -> its (head, child, label) edges
+    self.edges_by_child = defaultdict(set)  ## child -> its (head, child, label) edges
+    self.words2node = {}  ## frozenset of words -> the node with exactly those node2words
+
     self.node_blacklist = set()  ## just to make correctness easier
     self.node_whitelist = set()
   
@@ -90,8 +104,19 @@ class Parse:
 
   ## Accessors
 
-  def has_node_edge(head, child, label=None):
-    assert False, "unimplemented"
+  def has_node_edge(self, head, child, label=None):
+    """Is there a head->child edge with this label?  Undirected labels match either way round."""
+    if label in UndirectedEdges:
+      head,child = sorted([head,child])
+    return (head,child,label) in self.edges_by_head.get(head, ())
+
+  def edges_from(self, head):
+    """The (head, child, label) edges with this head"""
+    return self.edges_by_head.get(head, set())
+
+  def edges_to(self, child):
+    """The (head, child, label) edges with this child"""
+    return self.edges_by_child.get(child, set())
 
   def wordnode(self, word):
     """Get the node for this word, if any."""
@@ -102,11 +127,7 @@ class Parse:
     assert len(ns) <= 1, "more than one node for a word... shouldnt this be impossible?"
 
   def multiword_canonical_node(self, words):
-    swords = set(words)
-    for n,nodewords in self.node2words.items():
-      if swords == nodewords:
-        return n
-    return None
+    return self.words2node.get(frozenset(words))
 
 
 
@@ -121,9 +142,12 @@ class Parse:
     assert (head not in self.node_blacklist) and (child not in self.node_blacklist)
     if label in UndirectedEdges:
       node_order = sorted([head,child])
-      self.node_edges.add((node_order[0], node_order[1], label))
+      edge = (node_order[0], node_order[1], label)
     else:
-      self.node_edges.add((head,child,label))
+      edge = (head,child,label)
+    self.node_edges.add(edge)
+    self.edges_by_head[edge[0]].add(edge)
+    self.edges_by_child[edge[1]].add(edge)
 
   def add_nodeword_edge(self, node, word, label=None):
     """
@@ -132,28 +156,38 @@ class Parse:
     node and word are strings.
     """
     if label is None:
-      self.node2words[node].add(word)
+      words = self.node2words[node]
+      self._unindex_words(node)
+      words.add(word)
+      self.words2node.setdefault(frozenset(words), node)
     else:
       self.extra_node2words[node].add((word,label))
 
   def delete_node(self, node):
     """unfortunately it looks like we need to support this operation"""
-    if node in self.node2words: del self.node2words[node]
+    if node in self.node2words:
+      self._unindex_words(node)
+      del self.node2words[node]
     if node in self.node2id: del self.node2id[node]
-    if any(a==node or b==node for a,b,_ in self.node_edges):
+    if self.edges_from(node) or self.edges_to(node):
       assert False, "a node is being deleted that already has dependency edges... is something wrong?"
     self.node_blacklist.add(node)
 
+  def _unindex_words(self, node):
+    key = frozenset(self.node2words.get(node, ()))
+    if self.words2node.get(key) == node:
+      del self.words2node[key]
+
   ## END State manipulation
 
   def gc(self):
     # need to garbage collect stranded wordnodes
     wordnodes = {n for n in self.node2words if len(self.node2words[n])==1}
-    nodes_with_edges = set(flatten((h,c) for h,c,_ in self.node_edges))
-    orphan_wordnodes = wordnodes - nodes_with_edges
+    orphan_wordnodes = [n for n in wordnodes if not self.edges_from(n) and not self.edges_to(n)]
     orphan_wordnodes = [x for x in orphan_wordnodes if not x.startswith('$')]
     #print "BAD NODES", orphan_wordnodes
     for n in orphan_wordnodes:
+      self._unindex_words(n)
       del self.node2words[n]
 
     
@@ -171,6 +205,29 @@ class Parse:
 
     return d
 
+  @classmethod
+  def from_json(cls, d):
+    """A finalized Parse from a to_json() dict"""
+    p = cls()
+    p.tokens = list(d['tokens'])
+    for h,c,label in d['node_edges']:
+      p.add_node_edge(h, c, label)
+    for n,words in d['node2words'].items():
+      p.node2words[n]  ## keep empty entries
+      for w in words:
+        p.add_nodeword_edge(n, w)
+    for n,wordlabels in d['extra_node2words'].items():
+      p.extra_node2words[n]
+      for w,label in wordlabels:
+        p.add_nodeword_edge(n, w, label)
+    p.finalize()
+    return p
+
+  def compact(self):
+    """The same parse as a gfl_compact.CompactParse: frozen, and much smaller in memory."""
+    from gfl_compact import CompactParse
+    return CompactParse.from_parse(self)
+
   def __repr__(self):
     d = self.to_json()
     s = "Parse:"
@@ -186,15 +243,16 @@ def unicodify(s, encoding='utf8', *args):
   if isinstance(s,str): return s.decode(encoding, *args)
   return unicode(s)
 
-def parse(text_tokens, psf_code, check_semantics=False):
+def parse(text_tokens, psf_code, check_semantics=False, recognizers=None):
   """ 
   text_tokens is a list of strings: the allowable tokens.
   psf_code is a string, the literal GFL code
+  recognizers: optional Recognizers to reuse for the ANTLR path
 
   returns the semantic Parse
   """
   text_tokens = [unicodify(x) for x in text_tokens]
-  parsetree = antlr_parse(psf_code)
+  parsetree = antlr_parse(psf_code, recognizers=recognizers)
   tree = parsetree.tree
   all_leaves = list(leaves(tree))
   if not all_leaves:
@@ -206,6 +264,16 @@ def parse(text_tokens, psf_code, check_semantics=False):
 
   consistency_check(text_tokens, tree)
 
+  p = build_parse(text_tokens, tree)
+  p.finalize()
+  if check_semantics:
+    graph_semantics_check(p)
+  return p
+
+def build_parse(text_tokens, tree):
+  """
+  The Parse for an AST that passed consistency_check(), before finalize().
+  """
   p = Parse()
   p.tokens = text_tokens[:]
 
@@ -256,11 +324,22 @@ def parse(text_tokens, psf_code, check_semantics=False):
     else:
       assert False, "bad type %s %s" % (typ, TypeNames[typ])
 
-  p.finalize()
-  if check_semantics:
-    graph_semantics_check(p)
   return p
 
+def parse_many(tokens_codes, check_semantics=False):
+  """
+  tokens_codes is an iterable of (text_tokens, psf_code) pairs, as for parse().
+  Lazily yields, for each pair, either its semantic Parse or the exception
+  that parsing it raised; one bad annotation doesn't stop the rest.
+  The ANTLR recognizers are built once and reused for every pair.
+  """
+  recognizers = Recognizers()
+  for text_tokens, psf_code in tokens_codes:
+    try:
+      yield parse(text_tokens, psf_code, check_semantics=check_semantics, recognizers=recognizers)
+    except Exception, e:
+      yield e
+
 def show(antlr_node):
   n=antlr_node
   print TypeNames[n.getType()], n.token
@@ -268,6 +347,7 @@ def show(antlr_node):
 def process_chain(p, antlr_node):
   """
   This function does dispatch among all parse node types.
+  The node is an ANTLR CommonTree or a gfl_rdparser.Node; they look the same from here.
   It returns the Parse node associated with the GFL fragment.
   We usually call this the "head node".
 
@@ -283,22 +363,23 @@ def process_chain(p, antlr_node):
   """
 
   an = antlr_node
+  typ = an.getType()
   # print "PROCESSING",; show(an)
   # antlr_dump(an)
 
 
-  if an.getType() == TOKEN:
+  if typ == TOKEN:
     nodename = 'W(' + an.token.text + ')'
     p.add_nodeword_edge(nodename, an.token.text)
     return [nodename]
-  elif an.getType() == DOLLARTOKEN:
+  elif typ == DOLLARTOKEN:
     nodename = an.token.text
     return [nodename]
-  elif an.getType() == RARROW:
+  elif typ == RARROW:
     return process_head_child(p, an.children[1], an.children[0])
-  elif an.getType() == LARROW:
+  elif typ == LARROW:
     return process_head_child(p, an.children[0], an.children[1])
-  elif an.getType() == LRB:  # (
+  elif typ == LRB:  # (
     if len(an.children)==1:
       # promote a singleton into this place.
       return process_chain(p, an.children[0])
@@ -336,11 +417,11 @@ def process_chain(p, antlr_node):
     return [cbb_nodeid]
 
     
-  elif an.getType() == LCB:  # {
+  elif typ == LCB:  # {
     children_heads = [process_chain(p,c) for c in an.children]
     nodes = flatten(children_heads)
     return nodes
-  elif an.getType() == LSB:  # [
+  elif typ == LSB:  # [
     children_heads = [process_chain(p,c) for c in an.children]
     wordnodes = flatten(children_heads)
 
@@ -359,7 +440,7 @@ def process_chain(p, antlr_node):
     return [mw_node]
 
   else:
-    assert False, "unsupported type %s %s" % (n.getType(), TypeNames[n.getType()])
+    assert False, "unsupported type %s %s" % (typ, TypeNames[typ])
 
 def flatten(iter):
   return list(itertools.chain.from_iterable(iter))
@@ -414,18 +495,60 @@ def graph_semantics_check(parse):
   not graph definition checks."""
   # Check tree constraint
   for n in parse.nodes:
-    outbounds = [(h,c,l) for h,c,l in parse.node_edges if c==n and l is None]
+    outbounds = sorted((h,c,l) for h,c,l in parse.edges_to(n) if l is None)
     if len(outbounds) > 1:
       raise InvalidGraph("Violates tree constraint: node {} has {} outbound edges: {}".format(
         repr(n), len(outbounds), repr(outbounds)))
 
-def antlr_parse(code):
+def make_lexer(char_stream, lexer=None):
+  lexer = lexer or LEXER
+  if lexer == 'fast':
+    return FastLexer(char_stream)
+  elif lexer == 'antlr':
+    return psfLexer(char_stream)
+  else:
+    raise ValueError("unknown lexer %s" % repr(lexer))
+
+class NativeParseResult(object):
+  """Stands in for the ANTLR rule return value; only .tree is used."""
+  def __init__(self, tree):
+    self.tree = tree
+
+class Recognizers(object):
+  """
+  An ANTLR lexer, token stream and parser, built once and then pointed at new
+  input for each annotation, instead of being rebuilt every time.
+  """
+  def __init__(self, lexer=None):
+    self.lexer = make_lexer(None, lexer)
+    self.tokens = antlr3.CommonTokenStream(self.lexer)
+    self.parser = psfParser(self.tokens)
+
+  def annotate(self, code):
+    """code is unicode; returns the annotate rule's return value"""
+    self.lexer.setCharStream(antlr3.ANTLRStringStream(code))
+    self.tokens.setTokenSource(self.lexer)
+    self.parser.setTokenStream(self.tokens)
+    self.parser.following = []  ## BaseRecognizer.reset() leaves this alone
+    return self.parser.annotate()
+
+def antlr_parse(code, lexer=None, parser=None, recognizers=None):
+  """
+  Parse tree for GFL code, in .tree of the result.
+  lexer: 'fast' or 'antlr'; defaults to the module-level LEXER setting.
+  parser: 'native' or 'antlr'; defaults to the module-level PARSER setting.
+    The native parser does its own lexing, so 'lexer' only matters when it falls back.
+  recognizers: Recognizers to reuse for the ANTLR path; 'lexer' is then theirs.
+  """
   if isinstance(code,str): code = code.decode('utf8')
-  char_stream = antlr3.ANTLRStringStream(code)
-  lexer = psfLexer(char_stream)
-  tokens = antlr3.CommonTokenStream(lexer)
-  parser = psfParser(tokens)
-  parsetree = parser.annotate()
+  if (parser or PARSER) == 'native':
+    try:
+      return NativeParseResult(gfl_rdparser.rd_parse(code))
+    except gfl_rdparser.Fallback:
+      pass
+  elif (parser or PARSER) != 'antlr':
+    raise ValueError("unknown parser %s" % repr(parser))
+  parsetree = (recognizers or Recognizers(lexer)).annotate(code)
   if parsetree.tree is None:
     raise ParseError("failed to parse")
   return parsetree
@@ -582,6 +705,63 @@ def test_tree_constraint():
   p = goparse(string.letters, "a > z \n b > z")
   graph_semantics_check(p)
 
+def test_edge_index():
+  p = goparse(string.letters, "a > b < c \n $x :: d :: e \n a = c \n [f g] > b")
+  assert p.has_node_edge('W(b)', 'W(a)')
+  assert not p.has_node_edge('W(a)', 'W(b)')
+  assert not p.has_node_edge('W(b)', 'W(a)', 'Conj')
+  assert p.has_node_edge('W(c)', 'W(a)', 'Anaph') and p.has_node_edge('W(a)', 'W(c)', 'Anaph')
+  assert p.has_node_edge('$x', 'W(d)', 'Conj')
+  for n in p.nodes:
+    assert p.edges_from(n) == {e for e in p.node_edges if e[0]==n}
+    assert p.edges_to(n) == {e for e in p.node_edges if e[1]==n}
+  assert p.multiword_canonical_node(['g','f']) == 'MW(f_g)'
+  assert p.multiword_canonical_node(['b']) == 'W(b)'
+  assert p.multiword_canonical_node(['a','b']) is None
+
+def test_from_json():
+  for code in ["a > b < c \n $x :: d :: e \n a = c \n [f g] > b", "$x :: b :: (c d)", "(a b* c)"]:
+    p = goparse(string.letters, code)
+    q = Parse.from_json(json.loads(json.dumps(p.to_json())))
+    assert q.to_json() == p.to_json()
+    assert q.word2nodes == p.word2nodes
+
+def test_lexers_agree():
+  code = "$x :: {one wife} :: and \n $x > own < [smash burger] // hi"
+  trees = [antlr_parse(code, lexer=l).tree.toStringTree() for l in ('fast','antlr')]
+  assert trees[0] == trees[1]
+
+def test_parsers_agree():
+  tokens = "@ciaranyree it was on football wives , one of the players and his wife own smash burger".split()
+  code = "it > was < on < [football wives] \n one < of < (the > players) \n $x :: {one wife} :: and \n $x > own < [smash burger]"
+  native = parse(tokens, code)
+  global PARSER
+  PARSER = 'antlr'
+  try:
+    antlr = parse(tokens, code)
+  finally:
+    PARSER = 'native'
+  assert native.to_json() == antlr.to_json()
+
+def test_parse_many():
+  import pytest
+  global PARSER
+  tokens = "one of the good players".split()
+  codes = ["one < of < ({the good} > players)", "one < of (", "the > players", "nobody > players", "(of* the"]
+  for parser in ['native', 'antlr']:
+    PARSER = parser
+    try:
+      results = list(parse_many((tokens, c) for c in codes))
+    finally:
+      PARSER = 'native'
+    assert len(results) == len(codes)
+    assert isinstance(results[3], ParseError)
+    for code,result in zip(codes, results):
+      if isinstance(result, Exception):
+        with pytest.raises(type(result)):
+          goparse(tokens, code)
+      else:
+        assert result.to_json() == goparse(tokens, code).to_json()
 
 def assert_same(p1, p2):
   # Note this is a pretty lame test, it assumes nodes have common names between parses.
@@ -0,0 +1,291 @@
+"""
+Hand-written recursive-descent parser for psf.g, without the ANTLR runtime.
+("psfParser.py" is the ANTLR parser.)
+
+It builds the same tree the ANTLR parser does -- same node types, same token
+texts, same shape -- out of lightweight Node objects, which process_chain()
+in gfl_parser.py walks directly.
+
+The grammar is LL(1) except for choosing which kind of line comes next, and
+there we copy the lookahead of the generated DFA2.  Like the generated
+annotate rule, parsing stops quietly at the first token that cannot start a
+line.  Anything the generated parser would report as a syntax error raises
+Fallback instead, and gfl_parser.antlr_parse() re-runs the ANTLR path, so
+error messages and recovered trees do not change.
+
+Run the differential check against the ANTLR parser with:
+  python gfl_rdparser.py [files...]     (default: everything in anno/ and cbbs/)
+Run tests with:
+  py.test -v gfl_rdparser.py
+"""
+
+import sys
+from gfl_lexer import tokenize, Fallback
+from psfParser import DCOLON,DOLLARTOKEN,EOF,EQ,HEAD,INTTAG,LARROW,LCB,LRB,LSB,RARROW,RCB,RRB,RSB,TOKEN,VOCTAG
+
+## FIRST(line), also FIRST(expr) and FIRST(atom)
+ATOM_START = frozenset([DOLLARTOKEN, LRB, TOKEN, LCB, LSB])
+## what DFA2 accepts after a line-initial narrow to predict an expr line
+## (NEWLINE is in there too, but it is on the hidden channel)
+AFTER_NARROW = frozenset([LARROW, RARROW, DOLLARTOKEN, LRB, TOKEN, LCB, LSB, EOF])
+TAGS = frozenset([VOCTAG, INTTAG])
+
+class Node(object):
+  """
+  A parse tree node.  Has the slice of the CommonTree interface that
+  gfl_parser uses: getType(), .children, and .token with a .text.
+  The root of a multi-line annotation is a nil node, type 0 and no text.
+  """
+  __slots__ = ['type', 'text', 'children']
+
+  def __init__(self, type, text, children=None):
+    self.type = type
+    self.text = text
+    self.children = children or []
+
+  def getType(self):
+    return self.type
+
+  @property
+  def token(self):
+    return self if self.text is not None else None
+
+  def toStringTree(self):
+    """Same format as CommonTree.toStringTree()"""
+    if not self.children:
+      return self.text if self.text is not None else 'nil'
+    inner = ' '.join(c.toStringTree() for c in self.children)
+    if self.text is None:
+      return inner
+    return '(%s %s)' % (self.text, inner)
+
+  def __repr__(self):
+    return self.toStringTree()
+
+class RDParser(object):
+  """One instance per token list; call annotate() once."""
+
+  def __init__(self, tokens):
+    self.tokens = tokens + [(EOF, None)]
+    self.i = 0
+
+  def LA(self, k=1):
+    i = self.i + k - 1
+    return self.tokens[i][0] if i < len(self.tokens) else EOF
+
+  def match(self, ttype):
+    typ,text = self.tokens[self.i]
+    if typ != ttype:
+      raise Fallback(self.i)
+    self.i += 1
+    return text
+
+  def leaf(self, ttype):
+    return Node(ttype, self.match(ttype))
+
+  ## Rules, in psf.g order
+
+  def annotate(self):
+    lines = []
+    while self.LA() in ATOM_START:
+      lines.append(self.line())
+    if len(lines) == 1:
+      return lines[0]
+    return Node(0, None, lines)
+
+  def line(self):
+    typ = self.LA()
+    if typ in (LRB, LCB):
+      return self.expr()
+    if typ == TOKEN:
+      k = 2
+    elif typ == DOLLARTOKEN:
+      if self.LA(2) == DCOLON:
+        return self.conjexpr()
+      k = 2
+    else:  # LSB: look past the whole phrase
+      if self.LA(2) != TOKEN or self.LA(3) != TOKEN:
+        raise Fallback(self.i)
+      k = 4
+      while self.LA(k) == TOKEN:
+        k += 1
+      if self.LA(k) != RSB:
+        raise Fallback(self.i)
+      k += 1
+    after = self.LA(k)
+    if after == EQ:
+      return self.corefexpr()
+    if after in AFTER_NARROW:
+      return self.expr()
+    if typ == TOKEN and after in TAGS:
+      return self.tagexpr()
+    raise Fallback(self.i)
+
+  def corefexpr(self):
+    left = self.narrow()
+    text = self.match(EQ)
+    return Node(EQ, text, [left, self.narrow()])
+
+  def expr(self):
+    return self.lc()
+
+  def lc(self):
+    # right associative: fold up the chain from the right, instead of recursing
+    rcs = [self.rc()]
+    arrows = []
+    while self.LA() == LARROW:
+      arrows.append(self.match(LARROW))
+      rcs.append(self.rc())
+    tree = rcs.pop()
+    while arrows:
+      tree = Node(LARROW, arrows.pop(), [rcs.pop(), tree])
+    return tree
+
+  def rc(self):
+    tree = self.atom()
+    while self.LA() == RARROW:
+      text = self.match(RARROW)
+      tree = Node(RARROW, text, [tree, self.atom()])
+    return tree
+
+  def conjexpr(self):
+    var = self.leaf(DOLLARTOKEN)
+    text = self.match(DCOLON)
+    children = [var, self.atom()]
+    if self.LA() == DCOLON:
+      self.match(DCOLON)
+      children.append(self.atom())
+    return Node(DCOLON, text, children)
+
+  def atom(self):
+    typ = self.LA()
+    if typ in (DOLLARTOKEN, TOKEN, LSB):
+      return self.narrow()
+    if typ == LCB:
+      return self.curlyset()
+    if typ != LRB:
+      raise Fallback(self.i)
+    text = self.match(LRB)
+    children = [self.expr()]
+    while self.LA() in ATOM_START:
+      children.append(self.expr())
+    if self.LA() == HEAD:
+      children.append(self.leaf(HEAD))
+      while self.LA() in ATOM_START:
+        children.append(self.expr())
+    self.match(RRB)
+    return Node(LRB, text, children)
+
+  def narrow(self):
+    typ = self.LA()
+    if typ in (TOKEN, DOLLARTOKEN):
+      return self.leaf(typ)
+    if typ == LSB:
+      return self.phrase()
+    raise Fallback(self.i)
+
+  def curlyset(self):
+    text = self.match(LCB)
+    children = []
+    while self.LA() in ATOM_START:
+      children.append(self.atom())
+    self.match(RCB)
+    return Node(LCB, text, children)
+
+  def phrase(self):
+    text = self.match(LSB)
+    children = [self.leaf(TOKEN), self.leaf(TOKEN)]
+    while self.LA() == TOKEN:
+      children.append(self.leaf(TOKEN))
+    self.match(RSB)
+    return Node(LSB, text, children)
+
+  def tagexpr(self):
+    token = self.leaf(TOKEN)
+    typ = self.LA()
+    return Node(typ, self.match(typ), [token])
+
+def rd_parse(code):
+  """
+  Parse tree for GFL code (unicode), as Nodes.
+  Raises Fallback if this needs the ANTLR recognizers.
+  """
+  return RDParser(tokenize(code)).annotate()
+
+#############################################
+## Differential testing against the ANTLR parser
+
+def tree_tuple(node):
+  """(type, text, children) for either a Node or a CommonTree"""
+  token = node.token
+  return (node.getType(), token.text if token is not None else None,
+      [tree_tuple(c) for c in (node.children or [])])
+
+def antlr_tree(code):
+  import gfl_parser
+  return gfl_parser.antlr_parse(code, parser='antlr').tree
+
+def check_same(code):
+  """The native tree if it agrees with ANTLR's, None if it fell back; AssertionError otherwise."""
+  try:
+    tree = rd_parse(code)
+  except Fallback:
+    return None
+  expected = antlr_tree(code)
+  assert tree_tuple(tree) == tree_tuple(expected), (code, tree.toStringTree(), expected.toStringTree())
+  return tree
+
+def anno_codes(text):
+  """The GFL code in every '% ANNO' section of a container file.  Good enough for testing."""
+  codes = []
+  section = None
+  for line in text.split(u'\n'):
+    if line.startswith(u'%'):
+      section = line.strip()
+      if section == u'% ANNO':
+        codes.append([])
+    elif line.strip() == u'---':
+      section = None
+    elif section == u'% ANNO':
+      codes[-1].append(line)
+  return [u'\n'.join(c) for c in codes]
+
+def corpus_files():
+  import glob,os
+  d = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+  return sorted(glob.glob(d+'/anno/*.anno') + glob.glob(d+'/anno/*/*.anno') + glob.glob(d+'/cbbs/*/*.anno'))
+
+def check_files(filenames):
+  """Check every ANNO section, and each whole file as one big chunk of code.
+  Returns (number checked natively, number that fell back)."""
+  native = fallback = 0
+  for filename in filenames:
+    text = open(filename).read().decode('utf8')
+    for code in anno_codes(text) + [text]:
+      if check_same(code) is None:
+        fallback += 1
+      else:
+        native += 1
+  return native, fallback
+
+def test_trees():
+  for code in [u"a", u"a b", u"", u"a < b < c", u"a > b > c", u"a < b > c", u"a > b < c",
+      u"a <-- b --> c", u"(a b* c d)", u"(a)", u"(a b*)", u"{}", u"{a (b c)}", u"[a b] = c",
+      u"a = b = c", u"$x :: a :: b", u"$x :: {a b}", u"$x", u"$x = $y", u"{a b} = c",
+      u"a = b > c", u"> a", u"a < {b c} > d", u"(a b < c d > e)", u"[a b c] > d\ne < f"]:
+    assert check_same(code) is not None, code
+
+def test_fallback():
+  import pytest
+  for code in [u"a < ", u"(a b", u"a b)", u"[a]", u"a :: b", u"(* a)", u"a \\v", u"$x )"]:
+    with pytest.raises(Fallback):
+      rd_parse(code)
+
+def test_corpus():
+  native, fallback = check_files(corpus_files())
+  assert native > fallback
+
+if __name__=='__main__':
+  filenames = sys.argv[1:] or corpus_files()
+  native, fallback = check_files(filenames)
+  print "%d files: %d parse trees identical to ANTLR's, %d handed back to ANTLR" % (len(filenames), native, fallback)
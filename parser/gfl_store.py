@@ -0,0 +1,254 @@
+"""
+A binary file of finalized parses, read through mmap, so that sentence k can
+be fetched -- or a slice of sentences iterated -- without decoding anything
+else in the file.
+
+Each record is a CompactParse (gfl_compact.py) and its sentence id, written
+as raw little-endian int arrays plus the utf8 bytes of all its strings.
+After the records comes an index of record offsets, then a small JSON footer.
+
+  Store(filename)[k]            the k'th CompactParse
+  Store(filename).sentence_id(k)
+
+Build a store from .anno files with scripts/make_store.py.
+
+Run tests with:
+  py.test -v gfl_store.py
+"""
+
+import sys,os,struct,mmap,json
+from array import array
+from gfl_compact import CompactParse, LABELS, label_id
+
+MAGIC = 'GFLSTORE'
+VERSION = 1
+HEADER = struct.Struct('<8sIQQ')  ## magic, version, number of records, index offset
+COUNTS = struct.Struct('<10i')    ## see encode_record()
+OFFSET = struct.Struct('<Q')
+
+## The label ids used in files: the labels gfl_parser knows about.
+## LABELS can grow at runtime, and it might grow differently in another process.
+FILE_LABELS = tuple(LABELS)
+_file_label_ids = {label:i for i,label in enumerate(FILE_LABELS)}
+
+def _bytes(a):
+  if sys.byteorder == 'big':
+    a = array(a.typecode, a)
+    a.byteswap()
+  return a.tostring()
+
+def _array(typecode, data):
+  a = array(typecode)
+  a.fromstring(data)
+  if sys.byteorder == 'big':
+    a.byteswap()
+  return a
+
+def _file_labels(labels):
+  try:
+    return array('b', (_file_label_ids[LABELS[l]] for l in labels))
+  except KeyError, e:
+    raise ValueError("can't store label %s" % repr(e.args[0]))
+
+def encode_record(c, sentence_id=u''):
+  """The bytes for one CompactParse.  Safe to call in worker processes."""
+  named = [(i,n) for i,n in enumerate(c.names) if n is not None]
+  strings = [s.encode('utf8') for s in [sentence_id] + list(c.tokens) + [n for _,n in named]]
+  ends = array('i')
+  end = 0
+  for s in strings:
+    end += len(s)
+    ends.append(end)
+  blob = ''.join(strings)
+  ints = [c.edge_heads, c.edge_children, c.word_offsets, c.word_ids, c.extra_offsets, c.extra_ids,
+      array('i', [i for i,_ in named]), array('i', c.empty_keys), ends]
+  counts = COUNTS.pack(len(c.tokens), c.num_nodes, len(c.names), len(c.edge_heads), len(c.word_ids),
+      len(c.extra_ids), len(named), len(c.empty_keys), len(strings), len(blob))
+  return ''.join([counts] + [_bytes(a) for a in ints] +
+      [_bytes(_file_labels(c.edge_labels)), _bytes(_file_labels(c.extra_labels)), blob])
+
+def decode_record(data, offset=0, labels=None):
+  """(sentence_id, CompactParse) for the record at this offset in data (a str or mmap)"""
+  ntok, nnodes, nnames, nedges, nwords, nextra, nnamed, nempty, nstrings, nblob = COUNTS.unpack_from(data, offset)
+  p = [offset + COUNTS.size]
+  def take(typecode, n):
+    size = n * array(typecode).itemsize
+    a = _array(typecode, data[p[0]:p[0]+size])
+    p[0] += size
+    return a
+
+  c = CompactParse()
+  c.num_nodes = nnodes
+  c.edge_heads = take('i', nedges)
+  c.edge_children = take('i', nedges)
+  c.word_offsets = take('i', nnames+1)
+  c.word_ids = take('i', nwords)
+  c.extra_offsets = take('i', nnames+1)
+  c.extra_ids = take('i', nextra)
+  named_ids = take('i', nnamed)
+  c.empty_keys = tuple(take('i', nempty))
+  ends = take('i', nstrings)
+  c.edge_labels = take('b', nedges)
+  c.extra_labels = take('b', nextra)
+  if labels is not None:
+    c.edge_labels = array('b', (labels[l] for l in c.edge_labels))
+    c.extra_labels = array('b', (labels[l] for l in c.extra_labels))
+  blob = data[p[0]:p[0]+nblob]
+
+  strings = []
+  start = 0
+  for end in ends:
+    strings.append(blob[start:end].decode('utf8'))
+    start = end
+  c.tokens = tuple(strings[1:1+ntok])
+  names = [None] * nnames
+  for i,n in zip(named_ids, strings[1+ntok:]):
+    names[i] = n
+  c.names = tuple(names)
+  return strings[0], c
+
+class StoreWriter(object):
+  """
+  Writes a store, one record at a time.
+  Only the record offsets are kept in memory.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.f = open(filename, 'wb')
+    self.f.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+    self.offsets = []
+
+  def add(self, c, sentence_id=u''):
+    """Add a CompactParse, or a Parse"""
+    if not isinstance(c, CompactParse):
+      c = c.compact()
+    self.add_record(encode_record(c, sentence_id))
+
+  def add_record(self, record):
+    """Add a record made by encode_record()"""
+    self.offsets.append(self.f.tell())
+    self.f.write(record)
+
+  def close(self):
+    index_offset = self.f.tell()
+    for offset in self.offsets + [index_offset]:
+      self.f.write(OFFSET.pack(offset))
+    self.f.write(json.dumps({'labels': FILE_LABELS}))
+    self.f.seek(0)
+    self.f.write(HEADER.pack(MAGIC, VERSION, len(self.offsets), index_offset))
+    self.f.close()
+
+  def abort(self):
+    """Give up: close and delete the partly written file"""
+    self.f.close()
+    os.remove(self.filename)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    ## don't leave a partial store that looks finished
+    if exc_type is not None:
+      self.abort()
+    else:
+      self.close()
+
+class Store(object):
+  """
+  Read-only random access to a store file.
+  store[k] is the k'th CompactParse; store[i:j] decodes just those.
+  """
+  def __init__(self, filename):
+    self.f = open(filename, 'rb')
+    self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.count, self.index_offset = HEADER.unpack_from(self.data, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("%s is not a version %d parse store" % (filename, VERSION))
+    footer = json.loads(self.data[self.index_offset + OFFSET.size*(self.count+1):])
+    ## file label id -> label id in this process; None if they're the same
+    self.labels = [label_id(l) for l in footer['labels']]
+    if self.labels == range(len(self.labels)):
+      self.labels = None
+
+  def __len__(self):
+    return self.count
+
+  def offset(self, k):
+    return OFFSET.unpack_from(self.data, self.index_offset + OFFSET.size*k)[0]
+
+  def record(self, k):
+    """(sentence_id, CompactParse)"""
+    if k < 0: k += self.count
+    if not 0 <= k < self.count:
+      raise IndexError(k)
+    return decode_record(self.data, self.offset(k), self.labels)
+
+  def sentence_id(self, k):
+    return self.record(k)[0]
+
+  def __getitem__(self, k):
+    if isinstance(k, slice):
+      return [self.record(i)[1] for i in range(*k.indices(self.count))]
+    return self.record(k)[1]
+
+  def __iter__(self):
+    for k in range(self.count):
+      yield self[k]
+
+  def close(self):
+    self.data.close()
+    self.f.close()
+
+#############################################
+
+def store_of(records):
+  import tempfile,os
+  fd,filename = tempfile.mkstemp(suffix='.gfls')
+  os.close(fd)
+  with StoreWriter(filename) as w:
+    for sentence_id,c in records:
+      w.add(c, sentence_id)
+  return filename
+
+def test_roundtrip():
+  import os,string
+  from gfl_parser import parse
+  codes = ["a < b < c", "[b a] > (c d* e) \n $x :: {a c} :: {d e}", "a > b \n a = b", "$x :: b :: (c d)", "a"]
+  parses = [parse(string.letters, code) for code in codes]
+  tokens = u"caf\u00e9 \u2603 ok".split()
+  parses.append(parse(tokens, u"caf\u00e9 > \u2603"))
+  filename = store_of((u'sent%d' % i, p) for i,p in enumerate(parses))
+  try:
+    store = Store(filename)
+    assert len(store) == len(parses)
+    for i,p in enumerate(parses):
+      assert store[i].to_json() == p.compact().to_json()
+      assert store.sentence_id(i) == u'sent%d' % i
+    assert [c.to_json() for c in store[2:4]] == [p.compact().to_json() for p in parses[2:4]]
+    assert store[-1].tokens == tuple(tokens)
+    store.close()
+  finally:
+    os.remove(filename)
+
+def test_abort():
+  import os,string,tempfile,pytest
+  from gfl_parser import parse
+  fd,filename = tempfile.mkstemp(suffix='.store')
+  os.close(fd)
+  with pytest.raises(ValueError):
+    with StoreWriter(filename) as w:
+      w.add(parse(string.letters, "a < b"))
+      raise ValueError("stopped halfway")
+  assert not os.path.exists(filename)
+
+def test_empty():
+  import os,pytest
+  filename = store_of([])
+  try:
+    store = Store(filename)
+    assert len(store) == 0
+    with pytest.raises(IndexError):
+      store[0]
+    store.close()
+  finally:
+    os.remove(filename)
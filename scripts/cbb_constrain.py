@@ -1,4 +1,37 @@
-from graph import FUDGGraph, CBBNode
+import sys,os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../parser'))
+from graph import FUDGGraph, CBBNode, candidate_edges
+from spanningtrees import spanning_iter
+
+def cbb_groups(fudg):
+    """
+    For each CBB in fudg, the names of the lexical nodes inside it
+    (including those in CBBs nested inside it).
+    """
+    groups = []
+    for cbb in sorted(fudg.cbbnodes, key=lambda n: n.name):
+        words = set()
+        stack = list(cbb.members)
+        while stack:
+            n = stack.pop()
+            if n.isCBB:
+                stack.extend(n.members)
+            elif n.isLexical:
+                words.add(n.name)
+        groups.append(words)
+    return groups
+
+def single_heads(tree, groups):
+    """
+    Does the tree (a set of (parent, child) arcs) give each group of nodes
+    (see cbb_groups()) exactly one node with a parent outside it?
+    """
+    heads = [0] * len(groups)
+    for (head, child) in tree:
+        for i, words in enumerate(groups):
+            if child in words and head not in words:
+                heads[i] += 1
+    return all(h == 1 for h in heads)
 
 def constrain_cbbs(trees, fudg):
     """
@@ -8,44 +41,29 @@ def constrain_cbbs(trees, fudg):
     trees: potential dependency trees over fudg
     fudg: fudggraph for a document
     """
-    constrained = []
+    groups = cbb_groups(fudg)
+    return [t for t in trees if single_heads(t, groups)]
 
-    # build dict of cbb -> components
-    cbb_children = {}
-    for cbb in fudg.cbbnodes:
-        cbb_children[cbb.name] = cbb.members
-
-    def get_cbbs_containing(n):
-        cbbs = set()
-        for (cbb, children) in cbb_children:
-            if n in children:
-                cbbs.add(cbb)
-        return cbbs
-
-    def constrain(head, child, cbbs):
-        t_ok = True
-
-        for cbb in cbbs:
-            if head not in cbb:
-                if cbb in cbb_tops:
-                    if cbb_tops[cbb] != child:
-                        t_ok = False
-                        break
-                else:
-                    cbb_tops[cbb] = child
-        return t_ok
-
-    for t in trees:
-        t_ok = True
-        cbb_tops = {}
-        for (head, child) in t:
-            if not t_ok:
-                break
+def compatible_trees(fudg):
+    """
+    Yields the trees over fudg's candidate edges (see graph.downward()) that
+    have a single head in each CBB.  The constraint is enforced as the trees
+    are generated, so it's much faster than constrain_cbbs() on all of them.
+    """
+    return spanning_iter(candidate_edges(fudg), '$$', cbb_groups(fudg))
 
-            head_cbbs = get_cbbs_containing(head)
-            child_cbbs = get_cbbs_containing(child)
-            t_ok = constrain(head, child, head_cbbs) and\
-                constrain(head, child, child_cbbs)
-        if t_ok:
-            constrained.append(t)
-    return constrained
+def test():
+    import json
+    from graph import upward, downward
+    from spanningtrees import spanning
+    import gfl_parser
+    g = gfl_parser.parse("A Top Quality Sandwich made to artistic standards".split(),
+        "(A Top (Quality Sandwich)) > made > to > (artistic standards*)").to_json()
+    fudg = FUDGGraph(json.loads(json.dumps(g)))
+    upward(fudg)
+    downward(fudg)
+    assert sorted(map(sorted, cbb_groups(fudg))) == [['A', 'Quality', 'Sandwich', 'Top'], ['Quality', 'Sandwich'], ['artistic', 'standards']]
+    trees = spanning(candidate_edges(fudg), '$$')
+    constrained = constrain_cbbs(trees, fudg)
+    assert 0 < len(constrained) < len(trees)
+    assert sorted(map(sorted, compatible_trees(fudg))) == sorted(map(sorted, constrained))
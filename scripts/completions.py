@@ -0,0 +1,222 @@
+"""
+One entry point for the trees compatible with a FUDG graph (its completions),
+which picks how to work them out from how many there are.
+
+    from completions import completions
+    completions(fudg, 'count')
+    completions(fudg, 'enumerate', limit=1000)
+    completions(fudg, 'sample', limit=100, seed=0)
+    completions(fudg, 'marginals')
+
+The number of trees comes first, from a float log-determinant of the
+Laplacian (kirchhoff.py), which costs about the same whatever it is.  The
+counting, and going through all the trees when there are few, is done by
+independent parts (decompose.py).  Then:
+
+  count       exact (Bareiss) if it has at most EXACT_DIGITS digits, else
+              just the log
+  enumerate   all the trees if there are at most limit of them, else the
+              first limit (spanningtrees.spanning_iter())
+  sample      uniform random trees: drawn from the list of all of them if
+              there are at most ENUMERATE_LIMIT, else by Wilson's algorithm
+              (randomtrees.py)
+  marginals   the fraction of trees containing each candidate arc: counted
+              over all of them if there are at most ENUMERATE_LIMIT, else
+              from the inverse of the Laplacian
+
+The trees are the spanning trees of graph.candidate_edges() with one head
+per CBB (see cbb_constrain.py).  The determinant and the Laplacian inverse
+can't see that constraint, so for a graph with CBBs:
+
+  count       is exact if there are at most ENUMERATE_LIMIT trees without
+              the constraint (the ones with it are counted as they're listed),
+              else it's the count without it: an upper bound
+  enumerate   lists only trees with one head per CBB
+  sample      draws by Wilson's algorithm are rejected until they have one
+              head per CBB; if fewer than one in REJECT_LIMIT is kept, there
+              may be fewer than limit trees
+  marginals   from the Laplacian inverse are over all the trees, not just the
+              ones with one head per CBB
+
+The result is a dict with the answer, the count, which strategy ran, and how
+long each step took.  result['upper_bound'] says whether count and log_count
+are only upper bounds, and result['constrained'] whether the trees or
+marginals respect one head per CBB.
+"""
+
+import sys, os, math, random
+from timeit import default_timer as clock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../parser'))
+import graph
+import decompose
+from kirchhoff import arc_marginals
+from spanningtrees import spanning_iter
+from randomtrees import sample_spanningtrees
+from cbb_constrain import cbb_groups, single_heads
+
+REQUESTS = ['count', 'enumerate', 'sample', 'marginals']
+ENUMERATE_LIMIT = 20000   # at most this many trees: go through them all
+EXACT_DIGITS = 100        # count exactly if the count has at most this many digits
+DEFAULT_LIMIT = 1000      # trees to enumerate or sample
+REJECT_LIMIT = 100        # random trees drawn per sample wanted, at most
+
+def completions(fudg, request='count', limit=DEFAULT_LIMIT, seed=None, jobs=1):
+    """
+    Work out request ('count', 'enumerate', 'sample' or 'marginals') for
+    the trees compatible with a FUDGGraph; limit is the most trees to
+    enumerate, or the number to sample.  With jobs > 1, independent parts
+    are counted in a pool of that many processes.  Runs upward() and
+    downward() on fudg if they haven't been.
+    """
+    if request not in REQUESTS:
+        raise ValueError("unknown request %r: use one of %s" % (request, ', '.join(REQUESTS)))
+    seconds = {}
+    start = clock()
+    if any(n.parentcandidates is None for n in fudg.lexnodes):
+        graph.upward(fudg)
+        graph.downward(fudg, bitsets=True)
+    edges = graph.candidate_edges(fudg)
+    groups = cbb_groups(fudg)
+    log_count = decompose.count_spanningtrees(edges, '$$', log=True, jobs=jobs)
+    count = None
+    if log_count <= EXACT_DIGITS * math.log(10):
+        count = decompose.count_spanningtrees(edges, '$$', jobs=jobs)
+    small = count is not None and count <= ENUMERATE_LIMIT
+    alltrees = None
+    if small and groups:
+        # few enough to list: count the ones with one head per CBB
+        alltrees = list(spanning_iter(edges, '$$', groups))
+        count = len(alltrees)
+    if count:
+        log_count = math.log(count)
+    elif count == 0:
+        log_count = float('-inf')
+    seconds['count'] = clock() - start
+    upper_bound = bool(groups) and not small
+    result = {'request': request, 'count': count,
+              'log_count': log_count if log_count != float('-inf') else None,
+              'upper_bound': upper_bound, 'constrained': True,
+              'seconds': seconds}
+
+    def listed():
+        """all the trees, when there are few"""
+        return alltrees if alltrees is not None else list(decompose.spanning_iter(edges, '$$'))
+
+    t = clock()
+    if request == 'count':
+        if alltrees is not None:
+            result['strategy'] = 'enumerate'
+        else:
+            result['strategy'] = 'exact determinant' if count is not None else 'log determinant'
+        result['constrained'] = not upper_bound
+    elif request == 'enumerate':
+        trees = []
+        complete = True
+        for T in (alltrees if alltrees is not None else
+                  decompose.spanning_iter(edges, '$$') if small else spanning_iter(edges, '$$', groups)):
+            if len(trees) == limit:
+                complete = False
+                break
+            trees.append(T)
+        result['trees'] = trees
+        result['complete'] = complete
+        result['strategy'] = 'enumerate' if complete else 'enumerate prefix'
+    elif request == 'sample':
+        rng = random.Random(seed)
+        if count == 0:
+            result['trees'] = []
+            result['strategy'] = 'none'
+        elif small:
+            alltrees = listed()
+            result['trees'] = [set(rng.choice(alltrees)) for i in range(limit)]
+            result['strategy'] = 'enumerate'
+        else:
+            trees = []
+            for T in sample_spanningtrees(edges, '$$', limit * REJECT_LIMIT if groups else limit, seed=rng.random()):
+                if not groups or single_heads(T, groups):
+                    trees.append(T)
+                    if len(trees) == limit:
+                        break
+            result['trees'] = trees
+            result['strategy'] = 'wilson with rejection' if groups else 'wilson'
+    elif request == 'marginals':
+        if count == 0:
+            result['marginals'] = {e: 0.0 for e in edges}
+            result['strategy'] = 'none'
+        elif small:
+            tally = dict.fromkeys(edges, 0)
+            for T in listed():
+                for e in T:
+                    tally[e] += 1
+            result['marginals'] = {e: tally[e] / float(count) for e in edges}
+            result['strategy'] = 'enumerate'
+        else:
+            result['marginals'] = arc_marginals(edges, '$$')
+            result['strategy'] = 'laplacian inverse'
+            result['constrained'] = not groups
+    seconds[request] = clock() - t
+    seconds['total'] = clock() - start
+    return result
+
+def test():
+    import json
+    import gfl_parser
+    import kirchhoff
+
+    def fudg(words, code):
+        return graph.FUDGGraph(json.loads(json.dumps(gfl_parser.parse(words.split(), code).to_json())))
+
+    small = "A Top Quality Sandwich made to order"
+    code = "(A Top Quality Sandwich*) > made > to > order"
+    r = completions(fudg(small, code), 'count')
+    assert (r['count'], r['strategy'], r['upper_bound']) == (16, 'enumerate', False)
+    r = completions(fudg(small, code), 'enumerate', limit=5)
+    assert (len(r['trees']), r['complete'], r['strategy']) == (5, False, 'enumerate prefix')
+    r = completions(fudg(small, code), 'enumerate')
+    assert (len(r['trees']), r['complete'], r['strategy']) == (16, True, 'enumerate')
+    r = completions(fudg(small, code), 'sample', limit=50, seed=1)
+    assert r['strategy'] == 'enumerate' and len(r['trees']) == 50
+    f = fudg(small, code)
+    exact = completions(f, 'marginals')
+    assert exact['strategy'] == 'enumerate'
+    for e, m in arc_marginals(graph.candidate_edges(f), '$$').items():
+        assert abs(exact['marginals'][e] - m) < 1e-9
+
+    # nothing annotated: 41^39 trees over 40 words
+    words = ['w%d' % i for i in range(40)]
+    big = graph.FUDGGraph({'tokens': words, 'nodes': ['W(%s)' % w for w in words], 'node_edges': [],
+                           'node2words': {'W(%s)' % w: [w] for w in words}, 'extra_node2words': {}})
+    assert completions(big, 'count')['count'] == 41**39
+    r = completions(big, 'sample', limit=20, seed=1)
+    assert r['strategy'] == 'wilson' and len(r['trees']) == 20 and all(len(T) == 40 for T in r['trees'])
+    r = completions(big, 'marginals')
+    assert r['strategy'] == 'laplacian inverse'
+    assert abs(r['marginals'][('$$', 'w3')] - 2 / 41.0) < 1e-9  # a tree has 40 of the 41*40/2 edges, all equally likely
+    r = completions(big, 'enumerate', limit=10)
+    assert len(r['trees']) == 10 and not r['complete']
+
+    assert not r['upper_bound'] and r['constrained']
+
+    # one head per CBB rules out some of the spanning trees
+    from cbb_constrain import constrain_cbbs
+    words = "A Top Quality Sandwich made to artistic standards"
+    f = fudg(words, "(A Top (Quality Sandwich)) > made > to > (artistic standards*)")
+    allcount = completions(f, 'count')
+    r = completions(f, 'enumerate')
+    assert r['complete'] and len(r['trees']) == allcount['count'] < kirchhoff.count_spanningtrees(graph.candidate_edges(f), '$$')
+    assert len(constrain_cbbs(r['trees'], f)) == len(r['trees'])
+    # too many to list: the count is only an upper bound, but samples are constrained
+    f = fudg(words, '(%s)' % words)
+    r = completions(f, 'count')
+    assert r['upper_bound'] and not r['constrained'] and r['count'] > ENUMERATE_LIMIT
+    r = completions(f, 'sample', limit=20, seed=1)
+    assert r['strategy'] == 'wilson with rejection' and len(r['trees']) == 20
+    assert all(single_heads(T, cbb_groups(f)) for T in r['trees'])
+    assert not completions(f, 'marginals')['constrained']
+
+    try:
+        completions(big, 'parse')
+        assert False
+    except ValueError:
+        pass
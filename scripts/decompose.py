@@ -0,0 +1,234 @@
+"""
+Split tree counting and enumeration over a candidate graph G (a set of
+(parent, child) arcs, rooted at r) into independent subproblems.
+
+First, settled attachments are contracted away.  If all of a node's
+candidate parents are in one place (a single node, or a set of nodes already
+merged together), the node is merged into it: whichever of those arcs it
+takes, it can't make a cycle, so it's a choice independent of everything
+else.  In a FUDG graph that's every word whose head is annotated, and every
+word inside an attached fragment, which is most of them.
+
+Then what's left is split into strongly connected components.  Every arc
+between two components goes the same way in their topological order, so
+with the nodes in that order the root-reduced Laplacian is block triangular:
+the number of trees is the product of the determinants of the diagonal
+blocks, and each component's parents can be chosen independently of every
+other component's, as long as they make no cycle inside it.  So each
+component is its own subproblem: its nodes, the arcs among them, and its
+arcs in from outside, each outside parent hanging straight off r.  E.g.
+CBBs whose members can only attach inside the CBB or to its (settled) head
+come out as separate subproblems.
+
+    count_spanningtrees(G, r)            same as kirchhoff.count_spanningtrees(), by parts
+    count_spanningtrees(G, r, jobs=4)    the parts counted in a pool of 4 processes
+    spanning_iter(G, r)                  same trees as spanningtrees.spanning_iter()
+"""
+
+import math, itertools
+import kirchhoff
+import spanningtrees
+
+def contract(G, r):
+    """
+    Merge each node whose candidate parents are all in one (merged) node
+    into that node, repeatedly.  Returns (arcs, settled): arcs maps each arc
+    (u, v) between the merged nodes to the arcs of G it stands for, and
+    settled maps each node merged away to its arcs in G, one of which will
+    be its parent whatever else happens.  Merged nodes are named after the
+    one they were merged into.
+    """
+    merged = {}  # node -> the node it was merged into
+    def find(x):
+        while x in merged:
+            x = merged[x]
+        return x
+    into = {}  # node -> its arcs in G
+    for (u, v) in set(G):
+        if u != v and v != r:
+            into.setdefault(v, []).append((u, v))
+    settled = {}
+    changed = True
+    while changed:
+        changed = False
+        for v in sorted(into):
+            if v in merged:
+                continue
+            parents = {find(u) for (u, _) in into[v]}
+            parents.discard(v)  # arcs from inside v's own merged node can never be used
+            if len(parents) == 1:
+                p = parents.pop()
+                settled[v] = [(u, v) for (u, _) in into[v] if find(u) == p]
+                merged[v] = p
+                changed = True
+    arcs = {}
+    for v in into:
+        if v in merged:
+            continue
+        for (u, _) in into[v]:
+            if find(u) != v:
+                arcs.setdefault((find(u), v), []).append((u, v))
+    return arcs, settled
+
+def components(G, r):
+    """
+    The strongly connected components of the nodes of G but r, in
+    topological order (every arc between two of them goes from an earlier
+    one to a later one).
+    """
+    succ = {}
+    nodes = {x for e in G for x in e} - {r}
+    for (u, v) in G:
+        if u != v and v != r and u != r:
+            succ.setdefault(u, []).append(v)
+    # Tarjan's algorithm, with an explicit stack
+    index = {}
+    low = {}
+    onstack = set()
+    stack = []
+    sccs = []
+    for start in sorted(nodes):
+        if start in index:
+            continue
+        work = [(start, iter(succ.get(start, ())))]
+        index[start] = low[start] = len(index)
+        stack.append(start)
+        onstack.add(start)
+        while work:
+            u, it = work[-1]
+            for v in it:
+                if v not in index:
+                    index[v] = low[v] = len(index)
+                    stack.append(v)
+                    onstack.add(v)
+                    work.append((v, iter(succ.get(v, ()))))
+                    break
+                elif v in onstack:
+                    low[u] = min(low[u], index[v])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[u])
+                if low[u] == index[u]:
+                    scc = set()
+                    while True:
+                        x = stack.pop()
+                        onstack.discard(x)
+                        scc.add(x)
+                        if x == u:
+                            break
+                    sccs.append(scc)
+    sccs.reverse()  # Tarjan finds them sinks first
+    return sccs
+
+def subproblems(G, r):
+    """
+    Returns (settled, parts).  settled is as for contract().  parts has
+    (nodes, H, arcs) for each component of the contracted graph: H is a
+    graph rooted at r whose spanning trees are the ways of choosing parents
+    for those nodes, and arcs maps H's arcs to the arcs of G they stand for.
+    A parent p from outside the component shows up in H as (p, child) plus
+    a stand-in arc (r, p), which isn't in arcs.
+    """
+    G = set(G)
+    arcs, settled = contract(G, r)
+    nodes = {x for e in G for x in e} - {r} - set(settled)
+    comps = components(set(arcs) | {(x, x) for x in nodes}, r)
+    which = {}
+    for i, comp in enumerate(comps):
+        for x in comp:
+            which[x] = i
+    parts = [set() for comp in comps]
+    for (u, v) in arcs:
+        part = parts[which[v]]
+        part.add((u, v))
+        if u != r and which[u] != which[v]:
+            part.add((r, u))
+    for comp, part in zip(comps, parts):
+        for x in comp - {v for (u, v) in part}:
+            part.add((x, x))  # a node with no possible parent: still has to be spanned, so there are no trees
+    return settled, [(comp, part, {e: arcs[e] for e in part if e in arcs}) for comp, part in zip(comps, parts)]
+
+def _count(args):
+    H, r, log, weights = args
+    return kirchhoff.count_spanningtrees(H, r, log, weights)
+
+def count_spanningtrees(G, r, log=False, jobs=1):
+    """
+    kirchhoff.count_spanningtrees(G, r, log), as a product (or with log=True,
+    a sum) over subproblems().  With jobs > 1, the subproblems are counted in
+    a pool of that many processes.
+    """
+    settled, parts = subproblems(G, r)
+    tasks = [(H, r, log, {e: len(a) for (e, a) in arcs.items()}) for (nodes, H, arcs) in parts]
+    if jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            counts = pool.map(_count, tasks)
+        finally:
+            pool.close()
+    else:
+        counts = [_count(task) for task in tasks]
+    if log:
+        if float('-inf') in counts:
+            return float('-inf')
+        return math.fsum(counts + [math.log(len(a)) for a in settled.values()])
+    total = 1
+    for n in counts:
+        total *= n
+    for a in settled.values():
+        total *= len(a)
+    return total
+
+def spanning_iter(G, r):
+    """
+    The spanning trees of G rooted at r, as spanningtrees.spanning_iter(),
+    put together from the trees of each subproblem.  Each subproblem's trees
+    are listed up front, so this is for when the parts are small even if the
+    whole isn't.
+    """
+    settled, parts = subproblems(G, r)
+    choices = [[[e] for e in a] for a in settled.values()]
+    for (nodes, H, arcs) in parts:
+        # each tree's arcs into the component's nodes, without the stand-ins,
+        # and with every way of picking the arcs of G behind them
+        trees = []
+        for T in spanningtrees.spanning_iter(H, r):
+            trees.extend(itertools.product(*[arcs[e] for e in T if e[1] in nodes]))
+        if not trees:
+            return
+        choices.append(trees)
+    for combination in itertools.product(*choices):
+        T = set()
+        for part in combination:
+            T.update(part)
+        yield T
+
+def test():
+    import random
+    rng = random.Random(0)
+    for trial in range(300):
+        n = rng.randint(0, 7)
+        nodes = ['$$'] + ['n%d' % i for i in range(n)]
+        G = {(rng.choice(nodes), rng.choice(nodes[1:])) for i in range(rng.randint(0, 2*n))} if n else set()
+        G |= {('$$', x) for x in nodes[1:] if rng.random() < 0.3}
+        expected = kirchhoff.count_spanningtrees(G, '$$')
+        assert count_spanningtrees(G, '$$') == expected
+        if expected:
+            assert abs(count_spanningtrees(G, '$$', log=True) - math.log(expected)) < 1e-9
+        else:
+            assert count_spanningtrees(G, '$$', log=True) == float('-inf')
+        trees = sorted(map(sorted, spanning_iter(G, '$$')))
+        assert trees == sorted(map(sorted, spanningtrees.spanning_iter(G, '$$')))
+
+def test_parts():
+    # a fixed chain, with two CBB-like clusters whose members can attach to
+    # each other or to the head of the cluster
+    G = {('$$', 'a'), ('a', 'b'), ('b', 'x')} | {(x, y) for x in 'bcd' for y in 'cd' if x != y} \
+        | {(x, y) for x in 'aef' for y in 'ef' if x != y}
+    settled, parts = subproblems(G, '$$')
+    assert sorted(settled) == ['a', 'b', 'x']
+    assert sorted(sorted(nodes) for (nodes, H, arcs) in parts) == [['c', 'd'], ['e', 'f']]
+    assert count_spanningtrees(G, '$$') == 3 * 3 == kirchhoff.count_spanningtrees(G, '$$')
+    assert count_spanningtrees(G, '$$', jobs=2) == 9
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+How underspecified is each annotation?  Reads make_json.py output and, for each
+sentence, builds its FUDG graph (see graph.py), works out the candidate tops and
+parents of its CBBs, and counts the dependency trees compatible with it
+(see kirchhoff.py and decompose.py).  Outputs one JSON object per sentence, in input order:
+
+  {"id": ..., "tokens": 12, "lexnodes": 11, "cbbs": 2, "candidate_edges": 19,
+   "cbb_topcandidates": {"CBB1": 3, ...}, "cbb_parentcandidates": {"CBB1": 5, ...},
+   "trees": 42, "log_trees": 3.74, "ms": {"build": ..., "upward": ..., "downward": ..., "count": ...}}
+
+E.g.:
+  scripts/make_json.py anno/tweets/*.anno | scripts/fudg_stats.py
+  scripts/fudg_stats.py -j 8 -l parses.json.gz > stats.jsonl
+
+Input is read one line at a time, from files (.gz is fine) or stdin ('-', or no files).
+With -j N, sentences are analyzed in a pool of N processes; the output is the same,
+in the same order.  With -l, only the natural log of the number of trees is worked
+out (from a float determinant), which is much faster for long sentences.
+Sentences that can't be analyzed (e.g. with coordination, which graph.py doesn't
+handle yet) are reported on stderr and skipped.
+"""
+import sys,os,json,math,itertools
+from optparse import OptionParser
+from timeit import default_timer as clock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../parser'))
+import graph
+from decompose import count_spanningtrees
+from gfl_container import open_anno
+
+CHUNKSIZE = 16  ## sentences per task handed to a worker
+
+def json_lines(filenames):
+  """(sentence_id, parse JSON) for every line of make_json.py output"""
+  for filename in filenames or ['-']:
+    for line in open_anno(filename):
+      line = line.rstrip('\n')
+      if not line: continue
+      sentence_id,_,parse = line.split('\t', 2)
+      yield sentence_id, parse
+
+def analyze(sentence_id, parse_json, log_only=False):
+  """The stats for one sentence, as a dict"""
+  t0 = clock()
+  f = graph.FUDGGraph(json.loads(parse_json))
+  t1 = clock()
+  graph.upward(f)
+  t2 = clock()
+  graph.downward(f, bitsets=True)
+  t3 = clock()
+  edges = graph.candidate_edges(f)
+  if log_only:
+    trees = None
+    log_trees = count_spanningtrees(edges, '$$', log=True)
+  else:
+    trees = count_spanningtrees(edges, '$$')
+    log_trees = math.log(trees) if trees else float('-inf')
+  t4 = clock()
+  return {
+    'id': sentence_id,
+    'tokens': len(f.alltokens),
+    'lexnodes': len(f.lexnodes),
+    'cbbs': len(f.cbbnodes),
+    'candidate_edges': len(edges),
+    'cbb_topcandidates': {n.name: len(n.topcandidates) for n in f.cbbnodes},
+    'cbb_parentcandidates': {n.name: len(n.parentcandidates) for n in f.cbbnodes},
+    'trees': trees,
+    'log_trees': log_trees if log_trees != float('-inf') else None,
+    'ms': {'build': (t1-t0)*1e3, 'upward': (t2-t1)*1e3, 'downward': (t3-t2)*1e3, 'count': (t4-t3)*1e3},
+  }
+
+def run(item):
+  """(output line, None) for a sentence, or (None, error message) if it can't be analyzed"""
+  (sentence_id, parse_json), log_only = item
+  try:
+    stats = analyze(sentence_id, parse_json, log_only)
+  except Exception, e:
+    return None, "{id}\t{name}: {msg}".format(id=sentence_id, name=type(e).__name__, msg=e)
+  return json.dumps(stats, sort_keys=True), None
+
+def test_analyze():
+  import gfl_parser
+  p = gfl_parser.parse("A Top Quality Sandwich made to order".split(),
+      "(A Top Quality Sandwich*) > made > to > order")
+  stats = analyze('s1', json.dumps(p.to_json()))
+  assert stats['cbbs'] == 1 and stats['cbb_topcandidates'] == {'CBB1': 1}
+  # made > to > order is fixed; the trees differ inside the CBB
+  assert stats['trees'] == 16 and abs(stats['log_trees'] - math.log(stats['trees'])) < 1e-9
+  assert analyze('s1', json.dumps(p.to_json()), log_only=True)['trees'] is None
+  line, error = run((('s2', '{"tokens": []'), False))
+  assert line is None and error.startswith('s2\tValueError')
+
+if __name__=='__main__':
+  p = OptionParser(usage="%prog [-j N] [-l] [filename.json ...]")
+  p.add_option('-j', '--jobs', dest="jobs", type='int', default=1, help="analyze in N worker processes")
+  p.add_option('-l', '--log-only', dest="log_only", action='store_true', help="only estimate the log of the number of trees")
+  opts,args = p.parse_args()
+
+  items = itertools.izip(json_lines(args), itertools.repeat(opts.log_only))
+  if opts.jobs > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(opts.jobs)
+    results = pool.imap(run, items, CHUNKSIZE)
+  else:
+    results = itertools.imap(run, items)
+
+  nerrors = 0
+  for line,error in results:
+    if error is not None:
+      nerrors += 1
+      print>>sys.stderr, "FAILED\t" + error
+    else:
+      print line
+      sys.stdout.flush()
+  if nerrors:
+    print>>sys.stderr, "%d sentences could not be analyzed" % nerrors
@@ -55,9 +55,17 @@ class FUDGNode(TreeNode):
 		self.childedges = set()
 		self.parentedges = set()
 		self.parents = set()
-		self.height = 0
-		self.depth = 0
-		self.frag = Fragment({self}, {self})
+		self._height = 0
+		self._depth = 0
+		self._frag = Fragment({self}, {self})
+	
+	@property
+	def frag(self):
+		self._frag = self._frag.find()
+		return self._frag
+	@frag.setter
+	def frag(self, f):
+		self._frag = f
 	
 	def add_child(self, node, label=None):
 		assert self.name!=node.name
@@ -66,36 +74,39 @@ class FUDGNode(TreeNode):
 		self.childedges.add((node, label))
 		node.parentedges.add((self, label))
 		node.parents.add(self)
-		self._setMinHeight(node.height+1)
 		
-		self.frag |= node.frag	# unify the fragments, updating all references from member nodes
+		self.frag |= node.frag	# unify the fragments
 		self.frag.roots.remove(node)	# no longer a root because it has a parent
-		# recompute depths in the entire fragment
-		for n in self.frag.nodes:
-			n.depth = float('inf')
-		for n in self.frag.roots:
-			n._setMaxDepth(0)
+		self.frag.stale = True	# heights and depths are recomputed when next asked for
 	
 	def remove_child(self, child):
 		raise Exception('Not supported')
 	
-	def _setMinHeight(self, h):
-		if self.height<h:
-			self.height = h
-			for p in self.parents:
-				assert p.name!=self.name,(self,self.parents)
-				p._setMinHeight(h+1)
+	@property
+	def height(self):
+		'''length of the longest path down to a leaf'''
+		self.frag.update()
+		return self._height
 	
-	def _setMaxDepth(self, d):
-		if self.depth>d:
-			self.depth = d
-			for c in self.children:
-				c._setMaxDepth(d+1)
+	@property
+	def depth(self):
+		'''length of the longest path down from a root of the fragment, so parents always come before their children'''
+		self.frag.update()
+		return self._depth
 	
 	def __repr__(self):
 		return '<'+self.name+'>'
 	
-	def descendantsIter(self): return itertools.groupby(itertools.chain(self.children, itertools.imap(FUDGNode.descendantsIter, self.children)))
+	def descendantsIter(self):
+		'''each node below this one, once'''
+		seen = set()
+		stack = list(self.children)
+		while stack:
+			c = stack.pop()
+			if c not in seen:
+				seen.add(c)
+				yield c
+				stack.extend(c.children)
 	@property
 	def descendants(self): return set(self.descendantsIter())
 	
@@ -157,23 +168,66 @@ class CBBNode(FUDGNode):
 		FUDGNode.add_child(self, node)
 	
 class Fragment(object):
+	'''
+	A connected piece of the graph.  Fragments are merged union-find style: the merged-away one 
+	just points to the one it was merged into, and nodes find their current fragment through find().
+	Node heights and depths are computed for a whole fragment at once, in linear time, 
+	the first time they're needed after it has changed.
+	'''
 	def __init__(self, roots, nodes):
 		self.roots = roots
 		for root in roots:
 			assert root in nodes
 		self.nodes = nodes
+		self.mergedinto = None
+		self.stale = False
+	
+	def find(self):
+		f = self
+		while f.mergedinto is not None:
+			f = f.mergedinto
+		g = self
+		while g is not f:	# path compression
+			g.mergedinto, g = f, g.mergedinto
+		return f
 		
 	def __or__(self, that):
-		if self is not that:
-			# merge 'that' contents in with 'self'
-			self.roots |= that.roots
-			self.nodes |= that.nodes
-			
-			# update node references from 'that' to point to 'self'
-			for n in that.nodes:
-				n.frag = self
-			
-		return self
+		a, b = self.find(), that.find()
+		if a is not b:
+			# merge the smaller fragment's contents into the larger
+			if len(a.nodes)<len(b.nodes):
+				a, b = b, a
+			a.roots |= b.roots
+			a.nodes |= b.nodes
+			a.stale = a.stale or b.stale
+			b.roots = b.nodes = None
+			b.mergedinto = a
+		return a
+	
+	def update(self):
+		'''Recompute heights and depths of all nodes, if anything has changed'''
+		if not self.stale:
+			return
+		# topological order, parents first
+		nparents = {n: 0 for n in self.nodes}
+		for n in self.nodes:
+			for c in n.children:
+				nparents[c] += 1
+		order = [n for n in self.nodes if nparents[n]==0]
+		for n in order:
+			for c in n.children:
+				nparents[c] -= 1
+				if nparents[c]==0:
+					order.append(c)
+		assert len(order)==len(self.nodes),'cycle in fragment'
+		for n in order:
+			n._depth = 0
+		for n in order:
+			for c in n.children:
+				c._depth = max(c._depth, n._depth+1)
+		for n in reversed(order):
+			n._height = max([c._height+1 for c in n.children] or [0])
+		self.stale = False
 
 class Graph(object):
 	def __init__(self, nodes):
@@ -182,6 +236,15 @@ class Graph(object):
 	@property
 	def firmNodes(self):
 		return {n for n in self.nodes if n.isFirm}
+	
+	def bits2nodes(self, bits):
+		'''The set of nodes in a bitset (bit i for self.nodeorder[i])'''
+		nodes = set()
+		while bits:
+			low = bits & -bits
+			nodes.add(self.nodeorder[low.bit_length()-1])
+			bits ^= low
+		return nodes
 
 class FUDGGraph(Graph):
 	def __init__(self, graphJ):
@@ -234,6 +297,11 @@ class FUDGGraph(Graph):
 		
 		self.nodes = {self.root} | self.lexnodes | self.coordnodes | self.cbbnodes
 		
+		# dense node indices, for representing sets of nodes as integer bitsets (see downward())
+		self.nodeorder = sorted(self.nodes, key=lambda node: node.name)
+		for i,n in enumerate(self.nodeorder):
+			n.bit = 1 << i
+		
 		# edges
 		for p,c,lbl in graphJ['node_edges']:
 			pnode = self.nodesbyname[p]
@@ -264,7 +332,7 @@ def upward(F):
 	'''
 	Identify the possible top nodes (internal heads) for each CBB in the graph or fragment 
 	by traversing bottom-up.
-	Result: .topcandidates
+	Result: .topcandidates, and the same as a bitset in .topcandidatebits
 	'''
 	for n in sorted(F.nodes, key=lambda node: node.height):
 		assert not n.isCoord	# graph should have been simplified to remove coordination nodes
@@ -283,15 +351,23 @@ def upward(F):
 				else:
 					assert e is None
 			assert n not in n.topcandidates
+			n.topcandidatebits = 0
+			for c in n.topcandidates:
+				n.topcandidatebits |= c.bit
 			#print(n, 'TOPCANDIDATES', n.topcandidates)
 
-def downward(G):
+def downward(G, bitsets=False):
 	'''
 	For each lexical node, identify the possible attachments (heads, not CBBs) it might take in some full analysis.
 	For each CBB node, identify the possible attachments to non-CBB heads its *top node* (internal head) might take in some full analysis. 
 	If the node in question is unattached, that will be all non-CBB nodes that are not its descendants.
 	Result: .parentcandidates
+	
+	With bitsets=True, the sets are worked out as integer bitsets over G's nodes, 
+	which is much faster on long sentences; the result is the same.
 	'''
+	if bitsets:
+		return downward_bitsets(G)
 	for n in sorted(G.nodes, key=lambda node: node.depth):
 		assert not n.isCoord	# graph should have been simplified to remove coordination nodes
 		if not n.isRoot:
@@ -317,9 +393,60 @@ def downward(G):
 			#print()
 			assert n.parentcandidates,n.parentcandidates
 
+def downward_bitsets(G):
+	'''
+	downward() with each node set as an integer bitset (bit i for G.nodeorder[i]), 
+	so that unions and intersections are word-parallel.
+	Result: .parentcandidates, and the same as a bitset in .parentcandidatebits
+	'''
+	# descendant closures, bottom-up
+	descendantbits = {}
+	for n in sorted(G.nodes, key=lambda node: node.height):
+		bits = 0
+		for c in n.children:
+			bits |= c.bit | descendantbits[c]
+		descendantbits[n] = bits
+	firmbits = 0
+	for n in G.nodes:
+		if n.isFirm:
+			firmbits |= n.bit
+	
+	for n in sorted(G.nodes, key=lambda node: node.depth):
+		assert not n.isCoord	# graph should have been simplified to remove coordination nodes
+		if not n.isRoot:
+			cands = firmbits & ~n.bit & ~descendantbits[n]
+			for (p,e) in n.parentedges:
+				if p.isCBB:
+					if n in p.members:
+						c = 0
+						if p.topcandidatebits & n.bit:	# n might be the top of the CBB
+							c |= p.parentcandidatebits
+						if p.topcandidatebits!=n.bit:	# n might not be the top of the CBB
+							for m in p.members:
+								c |= m.bit
+							c &= ~n.bit
+						cands &= c
+					else:
+						assert n in p.externalchildren	# edge modifies a CBB
+						cands &= p.topcandidatebits	# can be any firm node that might be the top of the CBB
+				else:
+					assert p.isFirm
+					cands &= p.bit	# edge attaches to something other than a CBB, so we know it's for real
+			n.parentcandidatebits = cands
+			n.parentcandidates = G.bits2nodes(cands)
+			assert n.parentcandidates,n.parentcandidates
+
+def candidate_edges(G):
+	'''
+	The (parent name, child name) arcs that downward() allows, between lexical nodes and the root.
+	Every tree over the lexical nodes compatible with G is a spanning tree of these (see kirchhoff.py).
+	'''
+	return {(p.name,c.name) for c in G.lexnodes for p in c.parentcandidates}
+
 def test():
 	'''Some rudimentary test cases.'''
-	from spanningtrees import spanning
+	from spanningtrees import spanning_iter
+	from kirchhoff import count_spanningtrees
 	g1 = {'tokens': ['I', 'think', "I'm", 'a', 'wait', 'an', 'hour', 'or', '2', '&', 'THEN', 'tweet', '@sinittaofficial', '...'], 'node_edges': [['$a', 'W(tweet)', 'Conj'], ['$a', 'W(wait)', 'Conj'], ['$o', 'W(2)', 'Conj'], ['$o', 'W(hour)', 'Conj'], ["W(I'm)", '$a', None], ['W(hour)', 'W(an)', None], ['W(think)', "W(I'm)", None], ['W(think)', 'W(I)', None], ['W(tweet)', 'W(@sinittaofficial)', None], ['W(wait)', '$o', None]], 'nodes': ['$a', '$o', 'MW(&_THEN)', 'W(2)', 'W(@sinittaofficial)', "W(I'm)", 'W(I)', 'W(an)', 'W(hour)', 'W(think)', 'W(tweet)', 'W(wait)'], 'extra_node2words': {'$o': [['or', 'Coord']], '$a': [['&', 'Coord'], ['THEN', 'Coord']]}, 'node2words': {'W(@sinittaofficial)': ['@sinittaofficial'], "W(I'm)": ["I'm"], 'W(2)': ['2'], 'W(think)': ['think'], 'W(tweet)': ['tweet'], 'W(I)': ['I'], 'W(an)': ['an'], 'W(wait)': ['wait'], 'W(hour)': ['hour'], 'MW(&_THEN)': ['THEN', '&']}}
 	g2 = {"tokens": ["@mandaffodil", "lol", ",", "we", "are", "one", ".", "and", "that", "was", "me", "this", "weekend", "especially", ".", "maybe", "put", "it", "off", "until", "you", "feel", "like", "~", "talking", "again", "?"], "node_edges": [["CBB1", "W(again)", "unspec"], ["CBB1", "W(feel)", "cbbhead"], ["CBB1", "W(you)", None], ["MW(put_off)", "W(it)", None], ["MW(put_off)", "W(until)", None], ["W($$)", "W(are)", None], ["W($$)", "W(lol)", None], ["W($$)", "W(maybe)", None], ["W($$)", "W(was)", None], ["W(are)", "W(one)", None], ["W(are)", "W(we)", None], ["W(feel)", "W(like)", None], ["W(like)", "W(talking)", None], ["W(maybe)", "MW(put_off)", None], ["W(until)", "CBB1", None], ["W(was)", "W(me)", None], ["W(was)", "W(that)", None], ["W(was)", "W(weekend)", None], ["W(weekend)", "W(especially)", None], ["W(weekend)", "W(this)", None]], "nodes": ["CBB1", "MW(put_off)", "W($$)", "W(again)", "W(are)", "W(especially)", "W(feel)", "W(it)", "W(like)", "W(lol)", "W(maybe)", "W(me)", "W(one)", "W(talking)", "W(that)", "W(this)", "W(until)", "W(was)", "W(we)", "W(weekend)", "W(you)"], "extra_node2words": {}, "node2words": {"W(are)": ["are"], "W(especially)": ["especially"], "W(like)": ["like"], "W(again)": ["again"], "W(that)": ["that"], "W(me)": ["me"], "W($$)": ["$$"], "W(maybe)": ["maybe"], "MW(put_off)": ["put", "off"], "W(was)": ["was"], "W(until)": ["until"], "W(you)": ["you"], "W(we)": ["we"], "W(feel)": ["feel"], "W(it)": ["it"], "W(talking)": ["talking"], "W(this)": ["this"], "W(one)": ["one"], "W(lol)": ["lol"], "W(weekend)": ["weekend"]}}
 	g3 = {"tokens": ["A", "Top", "Quality", "Sandwich", "made", "to", "artistic", "standards", "."], "node_edges": [["CBB1", "W(A)", "unspec"], ["CBB1", "W(Quality)", "unspec"], ["CBB1", "W(Sandwich)", "cbbhead"], ["CBB1", "W(Top)", "unspec"], ["CBB2", "W(artistic)", "unspec"], ["CBB2", "W(standards)", "cbbhead"], ["W($$)", "CBB1", None], ["W(Sandwich)", "W(made)", None], ["W(made)", "W(to)", None], ["W(to)", "CBB2", None]], "nodes": ["CBB1", "CBB2", "W($$)", "W(A)", "W(Quality)", "W(Sandwich)", "W(Top)", "W(artistic)", "W(made)", "W(standards)", "W(to)"], "extra_node2words": {}, "node2words": {"W(made)": ["made"], "W(standards)": ["standards"], "W($$)": ["$$"], "W(to)": ["to"], "W(Top)": ["Top"], "W(artistic)": ["artistic"], "W(A)": ["A"], "W(Sandwich)": ["Sandwich"], "W(Quality)": ["Quality"]}}
@@ -329,18 +456,38 @@ def test():
 	for g in graphs:
 		f = FUDGGraph(g)
 		upward(f)
+		downward(f, bitsets=True)
+		bitsets = {n: n.parentcandidates for n in f.nodes if not n.isRoot}
 		downward(f)
+		assert bitsets=={n: n.parentcandidates for n in f.nodes if not n.isRoot}
+		for n in f.lexnodes:
+			assert not n.parentcandidates & n.descendants
 		for cbb in f.cbbnodes:
 			print(cbb.name, cbb.topcandidates, cbb.parentcandidates)
 		assert len({n.name for n in f.lexnodes})==len(f.lexnodes)
 		for c in f.lexnodes:
 			assert not c.isRoot
 			#print(c, c.parentcandidates)
-		stg = {(p.name,c.name) for c in f.lexnodes for p in c.parentcandidates}
+		stg = candidate_edges(f)
 		print(stg)
-		print(spanning(stg, '$$'))
-		print(len(spanning(stg, '$$')))
+		ntrees = count_spanningtrees(stg, '$$')
+		print(ntrees)
+		trees = list(itertools.islice(spanning_iter(stg, '$$'), 1000))	# there can be far too many to list them all
+		print(trees[:3])
+		assert len(trees)==min(ntrees, 1000)
 		#assert False
 
+def test_long_chain():
+	'''Building a deep graph is linear, with no recursion.'''
+	n = 5000
+	words = ['w%d' % i for i in range(n)]
+	g = {'tokens': words, 'nodes': ['W(%s)' % w for w in words], 'extra_node2words': {},
+	     'node2words': {'W(%s)' % w: [w] for w in words},
+	     'node_edges': [['W(%s)' % words[i+1], 'W(%s)' % words[i], None] for i in range(n-1)] + [['W($$)', 'W(%s)' % words[-1], None]]}
+	f = FUDGGraph(g)
+	assert f.root.height==n and f.root.depth==0
+	assert f.nodesbyname['W(w0)'].height==0 and f.nodesbyname['W(w0)'].depth==n
+	assert len(f.root.frag.nodes)==n+1 and f.root.frag.roots=={f.root}
+
 if __name__=='__main__':
 	test()
@@ -2,10 +2,26 @@
 Algorithm for backing off to matrix tree theorem if there are too many
 spanning trees to generate with spanningtree.py.
 
+count_spanningtrees() is exact: it takes the determinant of the integer
+Laplacian with fraction-free (Bareiss) elimination, so there's no rounding
+and no overflow however many trees there are.  With log=True it gives the
+natural log of the count from a float determinant instead, which is faster
+and plenty for comparing against a threshold.
+
+arc_marginals() gives, for every arc, the fraction of spanning trees that
+contain it (or with weights, the total weight of those trees over the total
+of all), from a single inverse of the Laplacian (Koo et al. 2007).
+
+The graph is a set of (parent, child) arcs, e.g. the candidate arcs from
+graph.downward():
+
+    count_spanningtrees(graph.candidate_edges(fudg), '$$')
+
 @author: Naomi Saphra (nsaphra@andrew.cmu.edu)
 @since: 2013-02-26
 """
 
+import math
 import numpy as np
 
 top_node = "$$"
@@ -57,21 +73,146 @@ def laplacian(G, r):
     adjacency = np.matrix(adjacencymat())
     return np.subtract(degree, adjacency)
 
+def reduced_laplacian(G, r, weights=None):
+    """
+    The Laplacian of laplacian() as integer lists, without the root's row
+    and column.  Repeated arcs count once, and self-loops not at all.
+    With weights (a dict from arcs to integers, 1 if missing), an arc counts
+    as that many parallel arcs.
+    """
+    nodes = {r: 0}
+    for (parent, child) in G:
+        nodes.setdefault(parent, len(nodes))
+        nodes.setdefault(child, len(nodes))
+    n = len(nodes) - 1
+    L = [[0] * n for i in range(n)]
+    for (parent, child) in set(G):
+        if parent == child or child == r:
+            continue
+        c = nodes[child] - 1
+        w = 1 if weights is None else weights.get((parent, child), 1)
+        L[c][c] += w
+        if parent != r:
+            L[c][nodes[parent] - 1] -= w
+    return L
+
+def bareiss_det(M):
+    """
+    Exact determinant of a square integer matrix (a list of lists, which
+    gets overwritten) by fraction-free elimination: O(n^3) operations, and
+    every intermediate value is itself a minor, so no fractions and no blowup.
+    """
+    n = len(M)
+    sign = 1
+    prev = 1
+    for k in range(n - 1):
+        if M[k][k] == 0:
+            for i in range(k + 1, n):
+                if M[i][k] != 0:
+                    M[k], M[i] = M[i], M[k]
+                    sign = -sign
+                    break
+            else:
+                return 0
+        pivot_row = M[k]
+        pivot = pivot_row[k]
+        tail = pivot_row[k+1:]
+        for i in range(k + 1, n):
+            row = M[i]
+            a = row[k]
+            if a == 0:
+                if pivot != prev:
+                    row[k+1:] = [(x * pivot) // prev for x in row[k+1:]]
+            else:
+                row[k+1:] = [(x * pivot - a * y) // prev for x, y in zip(row[k+1:], tail)]
+        prev = pivot
+    return sign * M[n-1][n-1] if n else 1
+
+def count_spanningtrees(G, r, log=False, weights=None):
+    """
+    The number of spanning trees of G rooted at r (every node reachable from
+    r, every node but r with exactly one parent), by the matrix tree theorem.
+    Exact, as a Python int.  With log=True, the natural log of the number
+    as a float (-inf if there are none).  weights are as for reduced_laplacian().
+
+    The log comes from a float determinant, and rounding can turn a singular
+    Laplacian (no trees) into a tiny determinant of either sign.  With integer
+    weights the determinant is an integer, so anything below 1/2 (or not
+    positive) is checked with the exact one.
+    """
+    L = reduced_laplacian(G, r, weights)
+    if log:
+        if not L:
+            return 0.0
+        sign, logdet = np.linalg.slogdet(np.array(L, dtype=float))
+        if (sign <= 0 or logdet < math.log(0.5)) and all(isinstance(x, (int, long)) for row in L for x in row):
+            n = bareiss_det(L)
+            return math.log(n) if n > 0 else float('-inf')
+        return logdet if sign > 0 else float('-inf')
+    return bareiss_det(L)
+
+def arc_marginals(G, r, weights=None):
+    """
+    For each arc (parent, child) of G, the fraction of G's spanning trees
+    rooted at r that contain it.  With weights (a dict from arcs to
+    nonnegative numbers, missing arcs getting 0), a tree counts for the
+    product of its arcs' weights.  Raises ValueError if there are no trees.
+    """
+    nodes = {r: -1}
+    for (parent, child) in G:
+        for x in (parent, child):
+            if x not in nodes:
+                nodes[x] = len(nodes) - 1
+    arcs = sorted({(parent, child) for (parent, child) in G if parent != child and child != r})
+    n = len(nodes) - 1
+    heads = np.array([nodes[parent] for (parent, child) in arcs], dtype=int)
+    mods = np.array([nodes[child] for (parent, child) in arcs], dtype=int)
+    if weights is None:
+        w = np.ones(len(arcs))
+    else:
+        w = np.array([weights.get(arc, 0.0) for arc in arcs], dtype=float)
+    # L[h,m] = -w(h,m) for non-root h, L[m,m] = total weight into m
+    L = np.zeros((n, n))
+    fromroot = heads < 0
+    np.add.at(L, (heads[~fromroot], mods[~fromroot]), -w[~fromroot])
+    np.add.at(L, (mods, mods), w)
+    # no trees exactly when some node can't be reached from r by arcs of
+    # positive weight; check that first, as the float determinant can't
+    # tell a singular L from a nearly singular one
+    children = {}
+    for (parent, child), x in zip(arcs, w):
+        if x > 0:
+            children.setdefault(parent, []).append(child)
+    seen = {r}
+    stack = [r]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            if child not in seen:
+                seen.add(child)
+                stack.append(child)
+    if len(seen) < len(nodes):
+        raise ValueError("No spanning trees rooted at %s: %d nodes can't be reached from it" % (r, len(nodes) - len(seen)))
+    Linv = np.linalg.inv(L) if n else L
+    marginals = w * Linv[mods, mods]
+    marginals[~fromroot] -= w[~fromroot] * Linv[mods[~fromroot], heads[~fromroot]]
+    result = dict(zip(arcs, marginals.tolist()))
+    for (parent, child) in G:
+        result.setdefault((parent, child), 0.0)  # self-loops and arcs into r
+    return result
+
 def spanningtree_bound(G, r):
     """
     Find the upper bound of the number of spanning trees of G
     as defined by Kirchhoff's theorem for directed graphs.
+    (It's the exact number; see count_spanningtrees().)
     """
-
-    laplace = laplacian(G, r)
-    print np.delete(laplace, 0, 0)
-    sink_reduced_laplace = np.delete(np.delete(laplace, (0), axis=0),
-                                     (0), axis=1)
-    return np.linalg.det(sink_reduced_laplace)
+    return count_spanningtrees(G, r)
 
 def test():
     def assert_good_result(G, r):
-        assert spanningtree_bound(G, r) == len(spanningtree.spanning(G, r))
+        n = len(spanningtrees.spanning(G, r))
+        assert spanningtree_bound(G, r) == n
+        assert abs(count_spanningtrees(G, r, log=True) - math.log(n)) < 1e-9
 
     import spanningtrees
     a = "a"
@@ -95,3 +236,48 @@ def test():
     #  |---^   
     #      
     assert_good_result(g1, top_node)
+
+def test_exact():
+    # complete digraph on n nodes plus a root that can head any of them:
+    # (n+1)^(n-1) trees, by Cayley's formula
+    for n in [1, 2, 5, 40]:
+        nodes = range(n)
+        G = {('$$', i) for i in nodes} | {(i, j) for i in nodes for j in nodes if i != j}
+        assert count_spanningtrees(G, '$$') == (n+1)**(n-1)
+        assert abs(count_spanningtrees(G, '$$', log=True) - (n-1)*math.log(n+1)) < 1e-6
+    assert count_spanningtrees([], '$$') == 1
+    assert count_spanningtrees([('$$', 'a'), ('b', 'c')], '$$') == 0
+    assert count_spanningtrees([('$$', 'a'), ('b', 'c')], '$$', log=True) == float('-inf')
+    # singular, but the float determinant rounds to about e^-35
+    G = [('$$', 'n0'), ('n2', 'n1'), ('n0', 'n1'), ('n3', 'n1'), ('n2', 'n0'), ('n2', 'n3'), ('n3', 'n2')]
+    assert count_spanningtrees(G, '$$') == 0
+    assert count_spanningtrees(G, '$$', log=True) == float('-inf')
+    assert count_spanningtrees([('$$', 'a'), ('$$', 'a'), ('a', 'a'), ('a', '$$')], '$$') == 1
+
+def test_marginals():
+    import itertools, random
+    from spanningtrees import spanning_iter
+    rng = random.Random(0)
+    for trial in range(50):
+        n = rng.randint(1, 6)
+        nodes = ['$$'] + ['n%d' % i for i in range(n)]
+        G = {('$$', 'n0')} | {(rng.choice(nodes), rng.choice(nodes[1:])) for i in range(3*n)}
+        trees = list(spanning_iter(G, '$$'))
+        if not trees:
+            continue
+        weights = {e: rng.choice([0.5, 1.0, 2.0]) for e in G}
+        for wts in [None, weights]:
+            score = lambda T: np.prod([wts[e] for e in T]) if wts else 1.0
+            Z = sum(score(T) for T in trees)
+            marginals = arc_marginals(G, '$$', wts)
+            assert set(marginals) == set(G)
+            for e in G:
+                assert abs(marginals[e] - sum(score(T) for T in trees if e in T) / Z) < 1e-9
+    assert arc_marginals([], '$$') == {}
+    singular = [('$$', 'n0'), ('n2', 'n1'), ('n0', 'n1'), ('n3', 'n1'), ('n2', 'n0'), ('n2', 'n3'), ('n3', 'n2')]
+    for G, wts in [([('$$', 'a'), ('b', 'c')], None), (singular, None), ([('$$', 'a'), ('a', 'b')], {('$$', 'a'): 1.0})]:
+        try:
+            arc_marginals(G, '$$', wts)
+            assert False
+        except ValueError:
+            pass
@@ -7,27 +7,130 @@ SentenceID TAB SpaceSepTokens TAB {ParseGraphAsJson}
 
 E.g.:
   scripts/make_json.py anno/tweets/dev.0000.anno
+  scripts/make_json.py -j 8 anno/tweets/*.anno
+  zcat dump.anno.gz | scripts/make_json.py -
+
+Files are read one record at a time, so they can be arbitrarily large; .gz files are
+read directly, and '-' is stdin.
+
+With -j N, sentences are parsed in a pool of N processes; the output is the same,
+in the same order.  Sentences that fail to parse are reported on stderr and skipped.
+
+With -C FILE, the CoNLL conversion of each sentence (see parser/gfl2conll.py) is
+written to FILE (.gz is fine) in the same pass, from the parse already made for the
+JSON instead of parsing it again.
+
+With -c FILE, parse results are kept in an on-disk cache (see parser/gfl_cache.py),
+so re-running over mostly unchanged files only parses what changed.
 
 ... It may be desirable to use ID information contained in other parts of the
 container, but I guess we'll use filenames for now...
 """
-import sys,re,os
+import sys,re,os,itertools
+from collections import deque
+from optparse import OptionParser
 try:
   import ujson as json
 except ImportError:
   import json
 import view
 import gfl_parser
+from gfl_container import read_containers, open_anno
+import gfl_cache
+from gfl2conll import parse2conll, open_output
+
+CHUNKSIZE = 64  ## sentences per task handed to a worker
+
+def sentences(filenames):
+  """(sentence_id, tokens, code) for every annotated sentence, in input order"""
+  for filename in filenames:
+    tokens_codes_annos = read_containers(open_anno(filename))
+    doc_id = re.sub(r'\.(anno|txt)(\.gz)?$','', filename)
+    # only need to look one record ahead to know if the file has more than one
+    first_two = list(itertools.islice(tokens_codes_annos, 2))
+    multi = len(first_two) > 1
+
+    for i,(tokens,code,anno) in enumerate(itertools.chain(first_two, tokens_codes_annos)):
+      if not code: continue
+      sentence_id = doc_id
+      if multi: sentence_id += ':' + str(i)
+      yield sentence_id, tokens, code
+
+def convert(item):
+  """
+  item is a sentence and its cached outcome (see gfl_cache.py), or None if it
+  isn't cached, and whether to convert it to CoNLL too.  Returns (output line,
+  CoNLL block or None, None, outcome) for the sentence, or (None, None, error
+  message, outcome) if it fails to parse.  If only the CoNLL conversion fails,
+  there's both an output line and an error message.
+  """
+  ((sentence_id, tokens, code), outcome), conll = item
+  if outcome is None:
+    outcome = gfl_cache.parse_outcome(tokens, code)
+  parse_json, error = outcome
+  if error is not None:
+    return None, None, "{id}\t{error}".format(id=sentence_id, error=error), outcome
+  line = "{id}\t{tokens}\t{parse}".format(id=sentence_id, tokens=' '.join(tokens), parse=parse_json)
+  if not conll:
+    return line, None, None, outcome
+  try:
+    return line, parse2conll(json.loads(parse_json), ' '.join(tokens)), None, outcome
+  except Exception, e:
+    return line, None, "{id}\tCoNLL {name}: {msg}".format(id=sentence_id, name=type(e).__name__, msg=e), outcome
+
+def lookup(sentences, cache, keys):
+  """(sentence, cached outcome) pairs; cache keys of the misses are queued onto keys"""
+  for sentence in sentences:
+    if cache is None:
+      yield sentence, None
+      continue
+    key = cache.key(sentence[1], sentence[2])
+    outcome = cache.get(key)
+    keys.append(None if outcome is not None else key)
+    yield sentence, outcome
 
-args = sys.argv[1:]
-for filename in args:
-  tokens_codes_annos = view.process_potentially_multifile(filename)
-  doc_id = re.sub(r'\.(anno|txt)$','', filename)
+if __name__=='__main__':
+  p = OptionParser(usage="%prog [-j N] [-c cachefile] [-C out.conll] filename.anno  [or multiple files]")
+  p.add_option('-j', '--jobs', dest="jobs", type='int', default=1, help="parse in N worker processes")
+  p.add_option('-c', '--cache', dest="cache", help="cache parses in this file")
+  p.add_option('-C', '--conll', dest="conll", help="also write the CoNLL conversion to this file")
+  opts,args = p.parse_args()
 
-  for i,(tokens,code,anno) in enumerate(tokens_codes_annos):
-    if not code: continue
-    sentence_id = doc_id
-    if len(tokens_codes_annos)>1: sentence_id += ':' + str(i)
-    parse = gfl_parser.parse(tokens,code)
-    print "{id}\t{tokens}\t{parse}".format(id=sentence_id, tokens=' '.join(tokens), parse=json.dumps(parse.to_json()))
+  cache = gfl_cache.ParseCache(opts.cache) if opts.cache else None
+  ## results come back in order, so the keys of the misses line up with them
+  keys = deque()
+  items = itertools.izip(lookup(sentences(args), cache, keys), itertools.repeat(bool(opts.conll)))
+  conllfile = open_output(opts.conll) if opts.conll else None
+  if opts.jobs > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(opts.jobs)
+    results = pool.imap(convert, items, CHUNKSIZE)
+  else:
+    results = itertools.imap(convert, items)
 
+  nerrors = 0
+  nconll_errors = 0  ## parsed, but the CoNLL conversion failed
+  for line,block,error,outcome in results:
+    if cache is not None:
+      key = keys.popleft()
+      if key is not None:
+        cache.put(key, outcome)
+    if error is not None:
+      if line is None:
+        nerrors += 1
+      else:
+        nconll_errors += 1
+      print>>sys.stderr, "FAILED\t" + error
+    if line is not None:
+      print line
+    if block is not None:
+      conllfile.write(block.encode('utf8') + "\n\n")
+  if nerrors:
+    print>>sys.stderr, "%d sentences failed to parse" % nerrors
+  if nconll_errors:
+    print>>sys.stderr, "%d sentences parsed but failed to convert to CoNLL" % nconll_errors
+  if conllfile is not None and conllfile is not sys.stdout:
+    conllfile.close()
+  if cache is not None:
+    print>>sys.stderr, cache.stats()
+    cache.close()
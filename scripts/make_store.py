@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+convert from annotations format to a binary parse store (see parser/gfl_store.py),
+which can be read back one sentence at a time without loading the rest.
+Sentence IDs are the same as make_json.py's.
+
+E.g.:
+  scripts/make_store.py -o tweets.gfls anno/tweets/*.anno
+  scripts/make_store.py -j 8 -o dump.gfls dump.anno.gz
+
+With -j N, sentences are parsed in a pool of N processes; the store is the same,
+in the same order.  Sentences that fail to parse are reported on stderr and skipped.
+"""
+import sys,itertools
+from optparse import OptionParser
+import make_json
+import gfl_parser
+import gfl_store
+
+def convert(sentence):
+  """(store record, None) for a sentence, or (None, error message) if it fails to parse"""
+  sentence_id, tokens, code = sentence
+  try:
+    parse = gfl_parser.parse(tokens,code)
+  except Exception, e:
+    return None, "{id}\t{name}: {msg}".format(id=sentence_id, name=type(e).__name__, msg=e)
+  return gfl_store.encode_record(parse.compact(), sentence_id), None
+
+if __name__=='__main__':
+  p = OptionParser(usage="%prog -o out.gfls [-j N] filename.anno  [or multiple files]")
+  p.add_option('-o', '--output', dest="output", help="store file to write")
+  p.add_option('-j', '--jobs', dest="jobs", type='int', default=1, help="parse in N worker processes")
+  opts,args = p.parse_args()
+  if not opts.output:
+    p.error("need an output file")
+
+  if opts.jobs > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(opts.jobs)
+    results = pool.imap(convert, make_json.sentences(args), make_json.CHUNKSIZE)
+  else:
+    results = itertools.imap(convert, make_json.sentences(args))
+
+  nerrors = 0
+  with gfl_store.StoreWriter(opts.output) as store:
+    for record,error in results:
+      if error is not None:
+        nerrors += 1
+        print>>sys.stderr, "FAILED\t" + error
+      else:
+        store.add_record(record)
+    print>>sys.stderr, "%d sentences stored in %s" % (len(store.offsets), opts.output)
+  if nerrors:
+    print>>sys.stderr, "%d sentences failed to parse" % nerrors
@@ -0,0 +1,127 @@
+"""
+Random spanning trees (arborescences) of a directed graph G, given as a set
+of (parent, child) arcs, rooted at r: for when there are too many to go
+through with spanningtrees.spanning_iter().
+
+random_spanningtree() uses Wilson's algorithm: from each node not yet in the
+tree, walk to random candidate parents until the walk hits the tree, then
+add the walk with its loops erased.  Every spanning tree is equally likely;
+with weights, a tree's probability is proportional to the product of its
+arcs' weights.  Each tree takes time proportional to the mean hitting time
+of the walk, which for FUDG candidate graphs is small.
+
+    G = graph.candidate_edges(fudg)
+    for T in sample_spanningtrees(G, '$$', 1000, seed=0):
+        ...
+    estimate(G, '$$', lambda T: ('$$', 'likes') in T)
+
+As with spanningtrees and kirchhoff, every node that appears in G has to be
+spanned.
+"""
+
+import random, bisect
+
+def _parent_choices(G, r, weights):
+    """For each node but r, its candidate parents and their cumulative weights"""
+    choices = {}
+    for (p, c) in G:
+        if p == c or c == r:
+            continue
+        w = 1.0 if weights is None else weights.get((p, c), 0.0)
+        if w < 0:
+            raise ValueError("negative weight for arc %s" % ((p, c),))
+        if w > 0:
+            choices.setdefault(c, ([], []))[0].append(p)
+            choices[c][1].append(w)
+    nodes = {x for e in G for x in e} | {r}
+    for c in choices:
+        ps, ws = choices[c]
+        order = sorted(range(len(ps)), key=lambda i: ps[i])  # so a seed gives the same trees every run
+        cum = []
+        total = 0.0
+        for i in order:
+            total += ws[i]
+            cum.append(total)
+        choices[c] = ([ps[i] for i in order], cum)
+
+    # every node must be reachable from r, or the walks never end
+    children = {}
+    for c in choices:
+        for p in choices[c][0]:
+            children.setdefault(p, []).append(c)
+    seen = {r}
+    stack = [r]
+    while stack:
+        for c in children.get(stack.pop(), ()):
+            if c not in seen:
+                seen.add(c)
+                stack.append(c)
+    if seen != nodes:
+        raise ValueError("No spanning trees: %d nodes unreachable from %s" % (len(nodes - seen), r))
+    return choices
+
+def _wilson(choices, r, rng):
+    intree = {r}
+    nxt = {}
+    for v in sorted(choices):
+        u = v
+        while u not in intree:
+            ps, cum = choices[u]
+            nxt[u] = ps[bisect.bisect_right(cum, rng.random() * cum[-1])] if len(ps) > 1 else ps[0]
+            u = nxt[u]
+        u = v
+        while u not in intree:  # following nxt from v retraces the walk with its loops erased
+            intree.add(u)
+            u = nxt[u]
+    return {(nxt[c], c) for c in choices}
+
+def random_spanningtree(G, r, weights=None, rng=random):
+    """
+    A random spanning tree of G rooted at r, as a set of (parent, child) arcs.
+    weights, if given, maps arcs to nonnegative numbers (arcs not in it get 0).
+    Raises ValueError if G has no spanning trees.
+    """
+    return _wilson(_parent_choices(G, r, weights), r, rng)
+
+def sample_spanningtrees(G, r, n, weights=None, seed=None):
+    """Yields n independent random spanning trees of G, as random_spanningtree()"""
+    rng = random.Random(seed)
+    choices = _parent_choices(G, r, weights)
+    for i in range(n):
+        yield _wilson(choices, r, rng)
+
+def estimate(G, r, f, n=1000, weights=None, seed=None):
+    """Monte Carlo estimate of the expected value of f(T) over spanning trees T of G"""
+    return sum(f(T) for T in sample_spanningtrees(G, r, n, weights, seed)) / float(n)
+
+def test():
+    from spanningtrees import spanning_iter
+    nodes = ['a', 'b', 'c']
+    G = {('$$', x) for x in nodes} | {(x, y) for x in nodes for y in nodes if x != y}
+    trees = [frozenset(T) for T in spanning_iter(G, '$$')]
+    assert len(trees) == 16
+    n = 16000
+    counts = {}
+    for T in sample_spanningtrees(G, '$$', n, seed=1):
+        counts[frozenset(T)] = counts.get(frozenset(T), 0) + 1
+    assert set(counts) == set(trees)
+    assert all(abs(k - n / 16) < 150 for k in counts.values()), counts  # sd is ~30
+
+    # weighted: P(T) is proportional to the product of its arcs' weights
+    weights = {e: 1.0 for e in G}
+    weights[('$$', 'a')] = 3.0
+    weights[('b', 'c')] = 0.0
+    score = lambda T: reduce(lambda x, e: x * weights[e], T, 1.0)
+    Z = sum(score(T) for T in trees)
+    for e in [('$$', 'a'), ('a', 'b'), ('b', 'c')]:
+        exact = sum(score(T) for T in trees if e in T) / Z
+        assert abs(estimate(G, '$$', lambda T: e in T, n, weights, seed=2) - exact) < 0.02
+
+    assert random_spanningtree({('$$', 'a')}, '$$') == {('$$', 'a')}
+    assert random_spanningtree(set(), '$$') == set()
+    for G in [{('a', 'b')}, {('$$', 'a'), ('b', 'c'), ('c', 'b')}]:
+        try:
+            random_spanningtree(G, '$$')
+            assert False
+        except ValueError:
+            pass
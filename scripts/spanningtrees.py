@@ -1,99 +1,211 @@
-# TODO this code is an atrocity
+"""
+Enumerate the spanning trees (arborescences) of a directed graph G, given
+as a set of (parent, child) arcs, rooted at r.
+
+spanning_iter() is a generator: trees come out one at a time, each a fresh
+set of (parent, child) arcs, and nothing else is kept around, so callers
+can stream and filter any number of them.  kirchhoff.count_spanningtrees()
+says how many there will be without enumerating them.
+
+It picks a parent for one node at a time, in breadth-first order from the
+root, keeping the choices in a parent array.  A choice is kept only if it
+closes no cycle and every node can still be reached from the root, i.e.
+the choices so far extend to at least one whole tree; so there are no
+dead ends, and the work between two trees is polynomial (O(V*E) at worst).
+That check is the expensive part, and most FUDG candidate graphs never hit
+a dead end without it, so it's only switched on after the first dead end.
+
+Every node that appears in G has to be spanned: if some node can't be
+reached from r there are no trees, as in the matrix tree theorem.
+
+Trees can also be required to have one head per group of nodes (e.g. the
+words of a CBB; see cbb_constrain.py): exactly one node of the group gets
+its parent from outside it.  That's checked as each parent is chosen, so
+branches that break it are cut as soon as a second node leaves a group.
+The reachability check above doesn't know about groups, though, so with
+them there can be dead ends after all: a partial tree whose remaining
+nodes can only be attached by giving some group a second head.
+"""
 
 THRESHOLD = 20000
 
-from graph import FUDGGraph
-import copy
-
-def find_tail(T, tail):
-    for (u,v) in T:
-        if v == tail:
-            return (u,v)
-    return None
-
-def find_head(T, head):
-    edges = []
-    for (u,v) in T:
-        if u == head:
-            edges.append((u,v))
-    return edges
-
-def dfs(G, r):
-    inds = {r:0}
-    ind = 0
-    edges = set()
-
-    trail = []
-    trail += find_head(G, r)
-    while (len(trail)):
-        (u,v) = trail.pop()
-        if v in inds:
+def spanning_iter(G, r, groups=()):
+    """
+    Yields each spanning tree of G rooted at r, as a set of (parent, child) arcs.
+    If groups (sets of nodes) are given, only trees where each group has just
+    one node with a parent outside it.
+    """
+    G = set(G)
+    # number the nodes: the root is 0, the rest in breadth-first order from it
+    children = {}
+    for (u, v) in G:
+        if u != v and v != r:
+            children.setdefault(u, []).append(v)
+    names = [r]
+    index = {r: 0}
+    for u in names:
+        for v in sorted(children.get(u, ())):
+            if v not in index:
+                index[v] = len(names)
+                names.append(v)
+    for (u, v) in G:
+        for x in (u, v):
+            if x not in index:
+                return  # unreachable from the root: no spanning trees
+    N = len(names)
+
+    cands = [[] for i in range(N)]  # possible parents of each node
+    out = [[] for i in range(N)]    # nodes each node is a possible parent of
+    for u in children:
+        for v in children[u]:
+            cands[index[v]].append(index[u])
+            out[index[u]].append(index[v])
+    for c in cands:
+        c.sort()
+    parent = [-1] * N  # -1 for no parent chosen (yet)
+
+    ingroups = [frozenset() for i in range(N)]  # the groups each node is in
+    ngroups = 0
+    for g in groups:
+        for x in g:
+            if x in index:
+                ingroups[index[x]] |= {ngroups}
+        ngroups += 1
+    heads = [0] * ngroups  # nodes in each group with a parent chosen from outside it
+
+    def set_parent(v, p):
+        """Choose p as v's parent, unless that gives a group two heads"""
+        leaves = ingroups[v] - ingroups[p]
+        for g in leaves:
+            if heads[g]:
+                return False
+        for g in leaves:
+            heads[g] += 1
+        parent[v] = p
+        return True
+
+    def unset_parent(v):
+        for g in ingroups[v] - ingroups[parent[v]]:
+            heads[g] -= 1
+        parent[v] = -1
+
+    def closes_cycle(p, v):
+        while p > 0:
+            if p == v:
+                return True
+            p = parent[p]
+        return False
+
+    def extendable():
+        # with the parents chosen so far, and any candidate parent for the
+        # rest, can every node still be reached from the root?  (groups
+        # aren't taken into account)
+        seen = [False] * N
+        seen[0] = True
+        stack = [0]
+        count = 1
+        while stack:
+            u = stack.pop()
+            for v in out[u]:
+                if not seen[v] and (parent[v] == -1 or parent[v] == u):
+                    seen[v] = True
+                    count += 1
+                    stack.append(v)
+        return count == N
+
+    if not extendable():
+        return
+    pos = [0] * N  # how far through cands[v] we've got, for each node on the stack
+    chosen = [False] * N  # has v had any parent that worked, since it was last reached?
+    prune = False  # check extendable() for each choice? (once we've hit a dead end)
+    v = 1
+    while v > 0:
+        if v == N:
+            yield {(names[parent[x]], names[x]) for x in range(1, N)}
+            v -= 1
+            if v > 0:
+                unset_parent(v)
             continue
-
-        edges.add((u,v))
-        ind += 1
-        inds[v] = ind
-        trail += find_head(G, v)
-
-    return (edges, inds)
-
-def ancestors(start, G, root):
-    anc = set([start])
-    curr = start
-    while curr != root:
-        (u,v) = find_tail(G, curr)
-        assert v == curr
-        anc.add(u)
-        curr = u
-    return anc
-
-def spanning(G, r):
-    (T0, inds) = dfs(G, r)
-    trees = [T0]
-
-    def getkey(x):
-        u,v = x
-        return inds[v]
-
-    def min_ind(T):
-        min = 0
-        for (u,v) in T:
-            if not min or inds[v] < min:
-                min = inds[v]
-        return min
-
-    def get_nonbacks(T, is_T0=False):
-        nonback = []
-        min = min_ind(T0 - T)
-
-        for (head, tail) in G:
-            if (head, tail) in T:
-                continue
-            if not is_T0 and inds[tail] >= min:
+        while pos[v] < len(cands[v]):
+            p = cands[v][pos[v]]
+            pos[v] += 1
+            if closes_cycle(p, v) or not set_parent(v, p):
                 continue
-        
-            if tail not in ancestors(head, T, r):
-                nonback.append((head, tail))
-
-        nonback.sort(key=getkey)
-        return nonback
-
-    def spanning_iter(T, nonback, lvl=0):
+            if not prune or extendable():
+                break
+            unset_parent(v)
+        if parent[v] != -1:
+            chosen[v] = True
+            v += 1
+            if v < N:
+                pos[v] = 0
+                chosen[v] = False
+        else:
+            if not chosen[v]:
+                prune = True  # a dead end: from now on, look ahead
+            pos[v] = 0
+            v -= 1
+            if v > 0:
+                unset_parent(v)
+
+def spanning(G, r, groups=()):
+    """
+    All spanning trees of G rooted at r (see spanning_iter()), in a list.
+    Raises an exception if there are more than THRESHOLD of them;
+    use spanning_iter() to go through any number.
+    """
+    trees = []
+    for T in spanning_iter(G, r, groups):
+        trees.append(T)
         if len(trees) > THRESHOLD:
             raise Exception("Too many spanning trees.")
-
-        for f in nonback:
-            u,v = f
-            e = find_tail(T, v)
-            Tc = copy.copy(T)
-            Tc.add(f)
-            Tc.remove(e)
-            trees.append(Tc)
-
-            Tc_nonback = get_nonbacks(Tc)
- 
-            spanning_iter(Tc, Tc_nonback, lvl+1)
-
-    nonback = get_nonbacks(T0, is_T0=True)
-    spanning_iter(T0, nonback)
     return trees
+
+def test():
+    import itertools, random
+    from kirchhoff import count_spanningtrees
+
+    def brute_force(G, r):
+        # every choice of one parent per node, kept if it's a tree
+        nodes = sorted({x for e in G for x in e} - {r})
+        cands = [sorted({u for (u, v) in G if v == n and u != n}) for n in nodes]
+        trees = set()
+        for choice in itertools.product(*cands):
+            parent = dict(zip(nodes, choice))
+            def reaches_root(n, seen=()):
+                return n == r or (n not in seen and reaches_root(parent[n], seen + (n,)))
+            if all(reaches_root(n) for n in nodes):
+                trees.add(frozenset(zip(choice, nodes)))
+        return trees
+
+    rng = random.Random(0)
+    for trial in range(200):
+        n = rng.randint(0, 6)
+        nodes = ['$$'] + ['n%d' % i for i in range(n)]
+        G = {(rng.choice(nodes), rng.choice(nodes[1:])) for i in range(rng.randint(0, 3*n))} if n else set()
+        trees = [frozenset(T) for T in spanning_iter(G, '$$')]
+        assert len(trees) == len(set(trees))
+        assert set(trees) == brute_force(G, '$$'), G
+        assert len(trees) == count_spanningtrees(G, '$$')
+
+def test_groups():
+    import random
+    rng = random.Random(1)
+    for trial in range(100):
+        n = rng.randint(1, 6)
+        nodes = ['$$'] + ['n%d' % i for i in range(n)]
+        G = {('$$', x) for x in nodes[1:]} | {(rng.choice(nodes), rng.choice(nodes[1:])) for i in range(3*n)}
+        groups = [set(rng.sample(nodes[1:], rng.randint(1, n))) for i in range(rng.randint(0, 2))]
+        def one_head(T, g):
+            return len([c for (p, c) in T if c in g and p not in g]) == 1
+        expected = [T for T in spanning_iter(G, '$$') if all(one_head(T, g) for g in groups)]
+        assert sorted(map(sorted, spanning_iter(G, '$$', groups))) == sorted(map(sorted, expected))
+
+def test_lazy():
+    import itertools
+    # a million million trees, but the first few come right away
+    nodes = range(12)
+    G = {('$$', i) for i in nodes} | {(i, j) for i in nodes for j in nodes if i != j}
+    first = list(itertools.islice(spanning_iter(G, '$$'), 1000))
+    assert len(set(frozenset(T) for T in first)) == 1000
+    assert all(len(T) == 12 for T in first)
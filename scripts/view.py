@@ -1,16 +1,22 @@
 #!/usr/bin/env python
 # vim:sts=4:sw=4
 from __future__ import division
-import re,sys,os,traceback
+import re,sys,os,traceback,glob,struct,subprocess,tempfile,hashlib,json
 from collections import defaultdict
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../parser'))
 import gfl_parser
+from gfl_container import parse_parts, read_containers, open_anno
+import gfl_cache
 
 show_words = False
+VERBOSE = False
 
 ROOT = '$$'
 
+DOT = 'dot'
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
 def is_balanced(s):
     def check(l,r):
         if l not in s and r not in s: return True
@@ -23,28 +29,6 @@ def is_balanced(s):
         return d==0
     return check('(',')') and check('[',']') and check('{','}')
 
-def parse_parts(tweet_text):
-    s = tweet_text
-    s = re.sub('^--- *', '', s)
-    lines = s.split('\n')
-    lines = [L.strip() for L in lines if L.strip()]
-
-    parts = re.split(r'(\n|^)%', s)
-    parts = [x.strip() for x in parts]
-    parts = [x for x in parts if x]
-    pairs = []
-    for part in parts:
-        lines = part.split('\n')
-        if len(lines)==1:
-            L = lines[0]
-            if len(L.split())==2:
-                pairs.append(L.split())
-                continue
-        key = lines[0].strip()
-        value = '\n'.join(lines[1:]).strip()
-        pairs.append((key,value))
-    return dict(pairs)
-
 def dot_clean(s, node_label=False):
     # s = s.replace('$','N_').replace('^','_')
     if node_label:
@@ -152,13 +136,101 @@ def make_html(basename, anno_text, png):
         print_html(out, anno_text, png)
     return html_filename
 
+def split_pngs(data):
+    """The PNG images concatenated in data (as dot writes them for a multi-graph input)"""
+    images = []
+    i = 0
+    while i < len(data):
+        if data[i:i+8] != PNG_SIGNATURE:
+            raise ValueError("no PNG at byte %d" % i)
+        j = i + 8
+        while True:
+            if j + 8 > len(data):
+                raise ValueError("truncated PNG at byte %d" % i)
+            length, kind = struct.unpack('>I4s', data[j:j+8])
+            j += 12 + length  ## length, type, data, CRC
+            if kind == 'IEND': break
+        if j > len(data):
+            raise ValueError("truncated PNG at byte %d" % i)
+        images.append(data[i:j])
+        i = j
+    return images
+
+_dot_missing = False  ## warned that dot can't be run?
+
+def start_dot(dots):
+    """
+    Start one dot process rendering the DOT graphs dots; returns (process,
+    input file, output file).  The process is None if dot can't be run.
+    """
+    fd,dotfile = tempfile.mkstemp(suffix='.dot')
+    with os.fdopen(fd, 'w') as f:
+        for dot in dots: print>>f, dot
+    fd,pngfile = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+    cmd = [DOT, '-Tpng', dotfile, '-o', pngfile]
+    if VERBOSE:
+        print ' '.join(cmd), "  # %d graphs" % len(dots)
+    try:
+        proc = subprocess.Popen(cmd)
+    except OSError, e:
+        global _dot_missing
+        if not _dot_missing:
+            print>>sys.stderr, "Can't run {DOT} ({e}); no pictures will be made".format(DOT=DOT, e=e)
+            _dot_missing = True
+        proc = None
+    return proc, dotfile, pngfile
+
+def render_pngs(dots, jobs=1):
+    """
+    Render each DOT graph in dots to PNG.  The graphs go through one dot process
+    as a single multi-graph stream (or with jobs > 1, split between that many
+    dot processes running at once), rather than a process per graph.
+    Returns the PNGs, in order, as strings; None for a graph dot couldn't render.
+    """
+    if not dots: return []
+    jobs = max(1, min(jobs, len(dots)))
+    size = -(-len(dots) // jobs)
+    chunks = [dots[k:k+size] for k in range(0, len(dots), size)]
+    running = [start_dot(chunk) for chunk in chunks]
+    pngs = []
+    for chunk,(proc,dotfile,pngfile) in zip(chunks, running):
+        status = proc.wait() if proc is not None else None
+        with open(pngfile, 'rb') as f: data = f.read()
+        os.remove(dotfile)
+        os.remove(pngfile)
+        if proc is None:
+            pngs.extend([None] * len(chunk))
+            continue
+        try:
+            images = split_pngs(data)
+        except ValueError:
+            images = []
+        if status != 0 or len(images) != len(chunk):
+            ## one bad graph fails the whole stream: render them one at a time
+            if len(chunk) == 1:
+                images = [None]
+            else:
+                images = [render_pngs([dot])[0] for dot in chunk]
+        pngs.extend(images)
+    return pngs
+
+def process_parses(dots_bases, jobs=1):
+    """
+    Write base.dot and base.png for each (DOT graph, base) pair; base is for OUTPUT.
+    Returns the PNGs, as render_pngs() (the .png is empty where that has None).
+    """
+    dots = [dot for dot,base in dots_bases]
+    for dot,base in dots_bases:
+        with open("{base}.dot".format(**locals()),'w') as f: print>>f, dot
+    pngs = render_pngs(dots, jobs)
+    for png,(dot,base) in zip(pngs, dots_bases):
+        with open("{base}.png".format(**locals()),'wb') as f:
+            if png is not None: f.write(png)
+    return pngs
+
 def process_one_parse(p, base):
-    # base is for OUTPUT
-    dot = psf2dot(p)
-    with open("{base}.dot".format(**locals()),'w') as f: print>>f, dot
-    cmd = "dot -Tpng < {base}.dot > {base}.png".format(**locals())
-    print cmd
-    os.system(cmd)
+    process_parses([(psf2dot(p), base)])
 
 def desktop_open(filename):
     # TODO how does this work on other platforms
@@ -169,27 +241,219 @@ def desktop_open(filename):
         
 def process_potentially_multifile(filename):
     # parse container format and return GFL code .. do NOT parse it yet
-    anno_text = open(filename).read().strip()
-    if '%' not in anno_text:
-        tokens = string.letters
-        code = anno_text
-        return [(tokens, code, anno_text)]
-    anno_text = anno_text.replace('\r\n','\n')
-    multi_annos = re.split(r'(\n|^)--- *(\n|$)', anno_text)
-    multi_annos = ['---\n' + x.strip() for x in multi_annos if x.strip()]
-    if len(multi_annos) == 0:
+    tuples = list(read_containers(open_anno(filename)))
+    if len(tuples) == 0:
         print "empty annotations"
         return None
-    tuples = []
-    for anno_text in multi_annos:
-        container = parse_parts(anno_text)
-        tokens = container.get('TEXT','').split()
-        code = container.get('ANNO','').strip()
-        tuples.append((tokens, code, anno_text))
     return tuples
 
+_view_version = None
+
+def record_hash(tokens, code):
+    """What a record's picture depends on: its parse (see gfl_cache.cache_key), -w, and this file"""
+    global _view_version
+    if _view_version is None:
+        filename = __file__[:-1] if __file__.endswith(('.pyc', '.pyo')) else __file__
+        with open(filename, 'rb') as f: _view_version = hashlib.sha1(f.read()).hexdigest()
+    return hashlib.sha1(json.dumps([gfl_cache.cache_key(tokens, code, check_semantics=True),
+        bool(show_words), _view_version])).hexdigest()
+
+def record_dot(item):
+    """
+    item is a record's (tokens, code, cached outcome or None); see gfl_cache.py.
+    Returns (outcome to cache or None, DOT graph, None), or (outcome to cache
+    or None, None, error message) if it doesn't parse.
+    """
+    tokens, code, outcome = item
+    if not is_balanced(code):
+        return None, None, "Unbalanced parentheses, brackets, or braces in annotation"
+    new = None
+    try:
+        if outcome is None:
+            try:
+                p = gfl_parser.parse(tokens, code, check_semantics=True)
+            except Exception, e:
+                new = (None, "{name}: {msg}".format(name=type(e).__name__, msg=e))
+                raise
+            new = (json.dumps(p.to_json()), None)
+        else:
+            if outcome[1] is not None:
+                return None, None, outcome[1]
+            p = gfl_parser.Parse.from_json(json.loads(outcome[0]))
+        return new, psf2dot(p), None
+    except Exception, e:
+        return new, None, "{name}: {msg}".format(name=type(e).__name__, msg=e)
+
+def build_report(filenames, index, jobs=1, cache=None):
+    """
+    Incremental batch mode: the same per-file HTML, .dot and .png files as
+    the ordinary batch mode, plus an index HTML page linking to all of them.
+
+    For each record, base.manifest next to its pictures keeps [hash, error]
+    (see record_hash()): error is None if the record was drawn, or why it
+    didn't parse.  A record whose hash hasn't changed is left alone: its
+    error is reported again, or its .png is kept, if it's still there.
+    Records that couldn't be drawn (e.g. dot failed) get null, so they're
+    tried again next time.  The records that changed, from all the files,
+    are parsed in a pool of jobs processes and rendered in one go (see
+    render_pngs()).
+    """
+    files = []     ## (filename, bigbase, records, bases, old manifest)
+    todo = []      ## (file number, record number, hash)
+    for filename in filenames:
+        bigbase = re.sub(r'\.(txt|anno)$','', filename)
+        records = list(read_containers(open_anno(filename)))
+        bases = [bigbase] if len(records) == 1 else ["%s.%d" % (bigbase,i) for i in range(len(records))]
+        try:
+            with open(bigbase + '.manifest') as f: old = json.load(f)
+        except (IOError, ValueError):
+            old = []
+        for i,(tokens,code,text) in enumerate(records):
+            if not code or not tokens: continue
+            h = record_hash(tokens, code)
+            if i < len(old) and isinstance(old[i], list) and old[i][0] == h:
+                if old[i][1] is not None: continue  ## fails the same way as before
+                if os.path.exists(bases[i] + '.png') and os.path.getsize(bases[i] + '.png'): continue
+            todo.append((len(files), i, h))
+        files.append((filename, bigbase, records, bases, old))
+
+    items = []
+    for (k,i,h) in todo:
+        tokens, code = files[k][2][i][:2]
+        items.append((tokens, code, cache.get(cache.key(tokens, code, True)) if cache is not None else None))
+    if jobs > 1 and len(items) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        results = pool.map(record_dot, items)
+        pool.close()
+    else:
+        results = map(record_dot, items)
+
+    entries = {}   ## (file number, record number) -> new manifest entry, for the records redone
+    pictures = []  ## (DOT graph, base) for the records to render
+    drawn = []     ## (file number, record number, hash) for each of pictures
+    for (k,i,h),(tokens,code,_),(outcome,dot,error) in zip(todo, items, results):
+        if cache is not None and outcome is not None:
+            cache.put(cache.key(tokens, code, True), outcome)
+        base = files[k][3][i]
+        if error is not None:
+            for ext in ('.dot', '.png'):
+                if os.path.exists(base + ext): os.remove(base + ext)
+            entries[k,i] = [h, error]
+            continue
+        entries[k,i] = None  ## unless it renders
+        pictures.append((dot, base))
+        drawn.append((k, i, h))
+    for png,(k,i,h) in zip(process_parses(pictures, jobs), drawn):
+        if png is not None:
+            entries[k,i] = [h, None]
+
+    changed = defaultdict(int)
+    for (k,i,h) in todo: changed[k] += 1
+    rows = []
+    for k,(filename,bigbase,records,bases,old) in enumerate(files):
+        manifest = []
+        for i,(tokens,code,text) in enumerate(records):
+            if (k,i) in entries:
+                manifest.append(entries[k,i])
+            elif code and tokens:
+                manifest.append(old[i])  ## unchanged
+            else:
+                manifest.append(None)
+        for i,entry in enumerate(manifest):
+            if entry is not None and entry[1] is not None:
+                print "FAILED\t{base}\t{error}".format(base=bases[i], error=entry[1])
+        with open(bigbase + '.manifest', 'w') as f: json.dump(manifest, f)
+
+        ## pictures of records that are gone: only the names this file's last
+        ## manifest used, as other inputs' pictures can look like ours
+        old_bases = [bigbase] if len(old) == 1 else ["%s.%d" % (bigbase,i) for i in range(len(old))]
+        for old_base in set(old_bases) - set(bases):
+            for ext in ('.png', '.dot'):
+                if os.path.exists(old_base + ext): os.remove(old_base + ext)
+
+        htmlfile = bigbase + '.html'
+        drawn_ok = [entry is not None and entry[1] is None for entry in manifest]
+        with open(htmlfile, 'w') as out:
+            print_header(out)
+            for i,(tokens,code,anno_text) in enumerate(records):
+                print_html(out, anno_text, bases[i] + '.png' if drawn_ok[i] else None)
+        nfailed = sum(1 for i,ok in enumerate(drawn_ok) if not ok and records[i][1] and records[i][0])
+        rows.append((htmlfile, len(records), changed.get(k, 0), nfailed))
+
+    with open(index, 'w') as out:
+        print_header(out)
+        print>>out, "<table>\n<tr><th align=left>file<th>records<th>updated<th>failed"
+        where = os.path.dirname(os.path.abspath(index))
+        for htmlfile,n,nchanged,nfailed in rows:
+            link = os.path.relpath(os.path.abspath(htmlfile), where)
+            print>>out, '<tr><td><a href="{link}">{link}</a><td align=right>{n}<td align=right>{nchanged}<td align=right>{nfailed}'.format(**locals())
+        print>>out, "</table>"
+    print "{} records, {} updated, {} failed; index in {}".format(
+        sum(r[1] for r in rows), len(todo), sum(r[3] for r in rows), index)
+    return rows
+
+def test_split_pngs():
+    import zlib
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    pngs = [PNG_SIGNATURE + chunk('IHDR', struct.pack('>IIBBBBB', n, 1, 8, 0, 0, 0, 0)) + chunk('IEND', '') for n in (1, 2, 3)]
+    assert split_pngs(''.join(pngs)) == pngs
+    assert split_pngs('') == []
+    for bad in [pngs[0][:-4], 'GIF89a']:
+        try:
+            split_pngs(bad)
+            assert False
+        except ValueError:
+            pass
+
+def test_build_report(tmpdir, monkeypatch):
+    fake_dot = """#!%s
+import sys, struct, zlib
+def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+graphs = open(sys.argv[2]).read().count('digraph')
+with open(sys.argv[sys.argv.index('-o') + 1], 'wb') as f:
+    for i in range(graphs):
+        f.write('\\x89PNG\\r\\n\\x1a\\n' + chunk('IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) + chunk('IEND', ''))
+""" % sys.executable
+    for name,source in [('dot', fake_dot), ('baddot', "#!/bin/sh\nexit 1\n")]:
+        tmpdir.join(name).write(source)
+        tmpdir.join(name).chmod(0755)
+    def anno(*codes):
+        return ''.join("---\n%% TEXT\n%s\n%% ANNO\n%s\n" % (' '.join(sorted(set(c.split()) - set('<>'))), c) for c in codes)
+    a = tmpdir.join('a.anno')
+    a.write(anno("x > y", "no > > way", "p < q"))
+    tmpdir.join('a.5.anno').write(anno("s > t"))  ## a.5.png looks like one of a.anno's
+    b = tmpdir.join('b.anno')
+    b.write(anno("one > two"))
+    files = [str(f) for f in (a, tmpdir.join('a.5.anno'), b)]
+    index = str(tmpdir.join('index.html'))
+    def run():
+        return [(n, nchanged, nfailed) for (html, n, nchanged, nfailed) in build_report(files, index)]
+
+    ## dot fails: nothing is drawn, and it's all tried again next time
+    monkeypatch.setattr(sys.modules[__name__], 'DOT', str(tmpdir.join('baddot')))
+    assert run() == [(3, 3, 3), (1, 1, 1), (1, 1, 1)]
+    assert tmpdir.join('b.png').size() == 0
+    monkeypatch.setattr(sys.modules[__name__], 'DOT', str(tmpdir.join('dot')))
+    assert run() == [(3, 2, 1), (1, 1, 0), (1, 1, 0)]
+    assert tmpdir.join('b.png').size() > 0 and tmpdir.join('a.2.png').size() > 0
+    ## nothing changed: nothing redone, and the parse failure is still reported
+    assert run() == [(3, 0, 1), (1, 0, 0), (1, 0, 0)]
+    ## one record edited; one picture deleted
+    a.write(anno("x > y", "no > > way", "q < p"))
+    b.join('..', 'b.png').remove()
+    assert run() == [(3, 1, 1), (1, 0, 0), (1, 1, 0)]
+    assert tmpdir.join('b.png').size() > 0
+    ## a.anno down to one record: its numbered pictures go, a.5.anno's stay
+    a.write(anno("x > y"))
+    assert run() == [(1, 1, 0), (1, 0, 0), (1, 0, 0)]
+    assert not tmpdir.join('a.0.png').check() and not tmpdir.join('a.2.png').check()
+    assert tmpdir.join('a.png').size() > 0 and tmpdir.join('a.5.png').size() > 0
+    assert run() == [(1, 0, 0), (1, 0, 0), (1, 0, 0)]
+
 if __name__=='__main__':
-    import string
     from optparse import OptionParser
     p = OptionParser(usage="""
     %prog filename.anno  [or multiple files]
@@ -199,6 +463,9 @@ if __name__=='__main__':
     p.add_option('-n', dest="supress_open", action='store_true', help="force to not open image when done")
     p.add_option('-v', dest="verbose", action='store_true', help="verbose mode")
     p.add_option('-m', dest="open_html", action='store_true', help="force to open html, not png, version")
+    p.add_option('-c', dest="cache", help="cache parses in this file, to skip re-parsing unchanged annotations")
+    p.add_option('-j', dest="jobs", type='int', default=1, help="render with N dot processes at once")
+    p.add_option('-r', dest="report", help="incremental batch mode: only redo changed records, parse them in N (-j) processes, and write an index of all the files to this HTML file")
     opts,args = p.parse_args()
     show_words = opts.show_words
     batch_mode = len(args) > 1
@@ -206,11 +473,17 @@ if __name__=='__main__':
     VERBOSE = opts.verbose
     multi_mode = None
     multi_annos = None
+    cache = gfl_cache.ParseCache(opts.cache) if opts.cache else None
+    parse_gfl = cache.parse if cache else gfl_parser.parse
 
     if not args:
         print "(use -h for help)"
         args = ['/dev/stdin']
 
+    if opts.report:
+        build_report(args, opts.report, opts.jobs, cache)
+        args = []
+
     for filename in args:
         print "FILE",filename
         if filename=='/dev/stdin':
@@ -225,7 +498,7 @@ if __name__=='__main__':
             try:
                 if not is_balanced(code):
                     raise Exception("Unbalanced parentheses, brackets, or braces in annotation")
-                parse = gfl_parser.parse(tokens, code, check_semantics=True)
+                parse = parse_gfl(tokens, code, check_semantics=True)
             except Exception:
                 if not batch_mode: raise
                 traceback.print_exc()
@@ -248,7 +521,7 @@ if __name__=='__main__':
                 try:
                     if not is_balanced(code):
                         raise Exception("Unbalanced parentheses, brackets, or braces in annotation:\n"+code)
-                    p = gfl_parser.parse(tokens, code, check_semantics=True)
+                    p = parse_gfl(tokens, code, check_semantics=True)
                     parses.append(p)
                 except Exception:
                     print code
@@ -256,20 +529,23 @@ if __name__=='__main__':
                     if not batch_mode: raise
                     traceback.print_exc()
                     continue
-        os.system("rm -f {bigbase}.*.png".format(**locals()))
+        for old in glob.glob(bigbase + '.*.png'):
+            os.remove(old)
 
         htmlfile = bigbase + '.html'
         out = open(htmlfile, 'w')
         print_header(out)
-        x = []
+        bases = ["%s.%d" % (bigbase,i) for i in range(len(parses))]
+        process_parses([(psf2dot(parse),base) for parse,base in zip(parses, bases) if parse is not None], opts.jobs)
         for i,parse in enumerate(parses):
             anno_text = tokens_codes_texts[i][2]
-            base = "%s.%d" % (bigbase,i)
-            print "\t",base
-            if parse is not None:
-                process_one_parse(parse, base)
-            print_html(out, anno_text, base + '.png' if parse is not None else None)
+            print "\t",bases[i]
+            print_html(out, anno_text, bases[i] + '.png' if parse is not None else None)
         out.close()
         if do_open:
             desktop_open(htmlfile)
 
+
+    if cache is not None:
+        print cache.stats()
+        cache.close()